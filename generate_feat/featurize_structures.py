@@ -0,0 +1,125 @@
+import sys
+import os
+import json
+import time
+import codecs
+import numpy as np
+import torch
+from multiprocessing import Pool
+from label_engine import ca_dist, c6d_bins
+from pdb_reader import read_atoms, residues, peptide_sequence, ideal_cb
+"""
+Single-pass structure featurizer, in place of running generate_fasta.py,
+generate_xyz.py, generate_ncaccb.py, generate_dis.py and generate_dis_angle.py
+one after the other.
+
+Every PDB is parsed once and all outputs of the target are written from that
+parse:
+  xxx.fasta          sequence of the peptides of the first model
+  xxx.xyz.npy        (L*3, 3) N, CA, C
+  xxx.ncaccb.npy     (L, 12) N, CA, C, ideal Cb
+  xxx.dis.npy        (L, L) float64 CA distances
+  xxx.dis_angle.npy  (L, L, 4) uint8 dist/omega/theta/phi bins
+  xxx.mask.npy       (L, L) bool pairs with Cb distance < DMAX
+L is the fasta length and residue i goes to row residue.id - 1, missing
+residues are NaN. A target that fails writes nothing; the reason goes to
+featurize_summary.json in out_base_dir.
+"""
+OUTPUTS = ["fasta", "xyz", "ncaccb", "dis", "dis_angle"]
+SUMMARY = "featurize_summary.json"
+CHUNK = 8
+
+def parse_structure(input_file):
+    """
+    sequence, (n, 3, 3) N/CA/C and residue index of every residue with a backbone
+    """
+    ncac, resid, chain, resname = residues(read_atoms(input_file))
+    seq = peptide_sequence(ncac, chain, resname)
+    ok = ~np.isnan(ncac).any(axis=(1, 2))
+    return seq, ncac[ok], resid[ok] - 1
+
+def featurize(input_file, L=None):
+    """
+    all outputs of one PDB file as arrays, L defaults to the sequence length
+    """
+    seq, ncac, sel_idxs = parse_structure(input_file)
+    if len(seq) == 0:
+        raise ValueError("no peptide in %s" % input_file)
+    L = len(seq) if L is None else L
+    if len(sel_idxs) == 0:
+        raise ValueError("no residue with N, CA and C")
+    if sel_idxs.min() < 0 or sel_idxs.max() >= L:
+        raise ValueError("residue numbers %d..%d outside the sequence of length %d" % (sel_idxs.min() + 1, sel_idxs.max() + 1, L))
+    ncaccb = np.full((L, 4, 3), np.nan)
+    ncaccb[sel_idxs, :3] = ncac
+    ncaccb[sel_idxs, 3] = ideal_cb(ncac)
+    return seq, ncaccb
+
+def write_target(out_base_dir, input_file, outputs=OUTPUTS):
+    pdb_name = input_file.split('/')[-1].split(".")[0]
+    out_dir = os.path.join(out_base_dir, pdb_name)
+    seq, ncaccb = featurize(input_file)
+    L = len(seq)
+    result = {}
+    if "xyz" in outputs:
+        result["xyz"] = ncaccb[:, :3].reshape(-1, 3)
+    if "ncaccb" in outputs:
+        result["ncaccb"] = ncaccb.reshape(L, 12)
+    if "dis" in outputs:
+        result["dis"] = ca_dist(ncaccb[None, :, 1])[0].numpy()
+    if "dis_angle" in outputs:
+        (result["dis_angle"], result["mask"]), = c6d_bins([ncaccb])
+    os.makedirs(out_dir, exist_ok=True)
+    if "fasta" in outputs:
+        with codecs.open(os.path.join(out_dir, pdb_name + ".fasta"), "w", "utf-8") as f:
+            f.write(">" + pdb_name + "\n" + seq)
+    for k, v in result.items():
+        np.save(os.path.join(out_dir, pdb_name + "." + k), v)
+    return pdb_name, L
+
+def init_worker():
+    # one process per core already, keep torch from spawning more threads
+    torch.set_num_threads(1)
+
+def _process_task(args):
+    out_base_dir, input_file, outputs = args
+    pdb_name = input_file.split('/')[-1].split(".")[0]
+    t = time.time()
+    try:
+        _, L = write_target(out_base_dir, input_file, outputs)
+        return {"name": pdb_name, "status": "ok", "length": L, "time": time.time() - t}
+    except Exception as e:
+        return {"name": pdb_name, "status": "error", "error": "%s: %s" % (type(e).__name__, e), "time": time.time() - t}
+
+def run(out_base_dir, pdb_list, n_cpu=1, outputs=OUTPUTS, chunk=CHUNK):
+    pdb_files = [line.strip() for line in open(pdb_list) if line.strip()]
+    tasks = [(out_base_dir, f, outputs) for f in pdb_files]
+    t = time.time()
+    if n_cpu > 1:
+        pool = Pool(n_cpu, initializer=init_worker)
+        results = pool.imap_unordered(_process_task, tasks, chunksize=chunk)
+    else:
+        pool = None
+        results = map(_process_task, tasks)
+    done, errors = 0, {}
+    try:
+        for r in results:
+            if r["status"] == "ok":
+                done += 1
+            else:
+                print("error", r["name"], r["error"])
+                errors[r["name"]] = r["error"]
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    summary = {"targets": len(tasks), "ok": done, "failed": len(errors), "outputs": outputs,
+               "time": time.time() - t, "errors": errors}
+    os.makedirs(out_base_dir, exist_ok=True)
+    with open(os.path.join(out_base_dir, SUMMARY), "w") as fh:
+        json.dump(summary, fh, indent=1)
+    print("featurized %d/%d targets in %.1fs, %d failed" % (done, len(tasks), summary["time"], len(errors)))
+    return summary
+
+if __name__ == '__main__':
+    run(sys.argv[1], "train-pdb.list", int(sys.argv[2]))
@@ -5,6 +5,7 @@ import os
 import numpy as np
 from multiprocessing import Pool,freeze_support
 from Bio import PDB
+import label_engine
 """
 CA x y z
 """
@@ -47,17 +48,7 @@ def get_pdbCA(input_file):
             all_coords.append(cur_bone)
     return pdb_name, np.array(all_coords)
 def get_pdb_dis(ca_coords):
-    L = len(ca_coords)
-    dis = []
-    for i in range(L):
-        x = ca_coords - ca_coords[i]
-        x = abs(x)
-        x = x * x
-        x = np.sum(x, 1)
-        x = x ** 0.5
-        x = x.tolist()
-        dis.append(x)
-    return np.array(dis)
+    return label_engine.ca_dist(np.asarray(ca_coords)[None])[0].numpy()
 
 def get_pdbCA2(input_file):
     def calc_residue_dist(residue_one, residue_two) :
@@ -88,21 +79,7 @@ def get_pdbCA3(input_file):
     return pdb_name, coordsCA
 def process(out_base_dir, pdb):
     pdb_name = pdb.split('/')[-1].split(".")[0]
-    out_dir = os.path.join(out_base_dir, pdb_name)
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
-    out_path = os.path.join(out_dir, pdb_name + ".dis")
-    # if os.path.exists(out_path + ".npy"):
-    #     return
-    pdb_name, coords = get_pdbCA3(pdb.strip())
-    if pdb_name is None:
-        return
-    dis = get_pdb_dis(coords)
-    np.save(out_path, dis)
+    label_engine.process_batch(out_base_dir, [pdb_name], ["dis"])
 if __name__ == '__main__':
     out_base_dir = sys.argv[1]
-    p = Pool(int(sys.argv[2]))
-    for line in open("train-pdb.list"):
-        p.apply_async(process, (out_base_dir, line.strip()))
-    p.close()
-    p.join()
+    label_engine.run(out_base_dir, "train-pdb.list", int(sys.argv[2]), outputs=["dis"])
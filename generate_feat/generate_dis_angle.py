@@ -7,6 +7,7 @@ from multiprocessing import Pool
 from Bio import PDB
 import math
 import torch
+import label_engine
 """
 CA x y z
 """
@@ -25,30 +26,12 @@ def get_pdbCA3(input_file):
     return pdb_name, coords
 
 def get_dis_class(v):
-    segs = np.arange(2.5, 20.5, 0.5)
-    for i,x in enumerate(segs):
-        if i == 0 and v < x:
-            return i
-        if v < x and v > segs[i-1]:
-            return i
-    return len(segs)
+    return label_engine.bin_index(v, np.arange(2.5, 20.5, 0.5))
 def get_omega_class(v):
-    segs = np.arange(0, math.pi * 2, 0.2)
-    for i,x in enumerate(segs):
-        if i == 0 and v < x:
-            return i
-        if v < x and v > segs[i-1]:
-            return i
-    return len(segs)
+    return label_engine.bin_index(v, np.arange(0, math.pi * 2, 0.2))
 
 def get_phipsi_class(v):
-    segs = np.arange(0, math.pi * 2, 0.1)
-    for i,x in enumerate(segs):
-        if i == 0 and v < x:
-            return i
-        if v < x and v > segs[i-1]:
-            return i
-    return len(segs)
+    return label_engine.bin_index(v, np.arange(0, math.pi * 2, 0.1))
 
 # ============================================================
 def get_pair_dist(a, b):
@@ -225,13 +208,14 @@ def process(out_base_dir, pdb):
     c6d[i,j,3] = c6d[i,j,3] // step2
     c6d[...,3][c6d[...,3]>=one_hot_omega] = one_hot_omega
 
-    mask = np.zeros((L,L))
-    mask[i,j] = 1.0
+    mask = np.zeros((L,L), dtype=bool)
+    mask[i,j] = True
     # c6d[...,:1] = c6d[...,:1]*mask / 20
     # c6d[...,1:] = c6d[...,1:]*mask / (math.pi * 2)
     try:
         print ("save is", pdb, out_path)
-        c6d = c6d.astype(np.int)
+        # bins fit in uint8 (at most 36), widened only at the loss
+        c6d = c6d.astype(np.uint8)
         np.save(out_path, c6d)
         out_path = os.path.join(out_dir, pdb_name + ".mask")
         np.save(out_path, mask)
@@ -239,32 +223,8 @@ def process(out_base_dir, pdb):
         print(e)
 def process_new(out_base_dir, pdb):
     pdb_name = pdb.split('/')[-1].split(".")[0]
-    out_dir = os.path.join(out_base_dir, pdb_name)
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
-    out_path = os.path.join(out_dir, pdb_name + ".dis_angle")
-    pdb_name, xyz = get_pdbCA3(pdb.strip())
-    xyz = xyz.reshape(-1, 4, 3)
-    if pdb_name is None:
-        return
-
-    c6d, mask = xyz_to_c6d(torch.from_numpy(xyz).float())
-
-    # c6d[...,:1] = c6d[...,:1]*mask / 20
-    # c6d[...,1:] = c6d[...,1:]*mask / (math.pi * 2)
-    try:
-        c6d = c6d.numpy()
-        mask = mask.numpy()
-        print ("save is", pdb, out_path)
-        np.save(out_path, c6d)
-        out_path = os.path.join(out_dir, pdb_name + ".mask")
-        np.save(out_path, mask)
-    except Exception as e:
-        print(e)
+    label_engine.process_batch(out_base_dir, [pdb_name], ["dis_angle"])
 if __name__ == '__main__':
     out_base_dir = sys.argv[1]
-    p = Pool(int(sys.argv[2]))
-    for line in open("train-pdb.list"):
-        p.apply_async(process_new, (out_base_dir, line.strip()))
-    p.close()
-    p.join()
+    # targets are binned in padded batches, see label_engine
+    label_engine.run(out_base_dir, "train-pdb.list", int(sys.argv[2]), outputs=["dis_angle"])
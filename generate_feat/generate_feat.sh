@@ -1,9 +1,11 @@
 DATA_PATH=../train-data
 
 #python3 split_pdb.py $DATA_PATH 10
-python3 generate_fasta.py $DATA_PATH 1
-python3 generate_xyz.py $DATA_PATH 1
+# fasta, xyz, ncaccb, dis and dis_angle in one pass over every pdb
+python3 featurize_structures.py $DATA_PATH 1
+# python3 generate_fasta.py $DATA_PATH 1
+# python3 generate_xyz.py $DATA_PATH 1
 # python3 generate_dis.py $DATA_PATH 1
-python3 generate_ncaccb.py $DATA_PATH 1
-python3 generate_dis_angle.py $DATA_PATH 1
+# python3 generate_ncaccb.py $DATA_PATH 1
+# python3 generate_dis_angle.py $DATA_PATH 1
 # python3 generate_msa.py $DATA_PATH
\ No newline at end of file
@@ -0,0 +1,163 @@
+import sys
+import os
+import numpy as np
+import torch
+from multiprocessing import Pool
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "network"))
+from kinematics import PARAMS, xyz_to_c6d, c6d_to_bins2
+"""
+Batched label engine behind generate_dis.py and generate_dis_angle.py.
+
+Structures are sorted by length and packed into NaN-padded batches of at
+most MAX_TOKENS residue pairs; every batch goes through xyz_to_c6d +
+c6d_to_bins2 once (with the stored Cb), and all outputs of a target are written in one pass:
+  xxx.dis.npy        (L, L) float64 CA distances
+  xxx.dis_angle.npy  (L, L, 4) uint8 dist/omega/theta/phi bins
+  xxx.mask.npy       (L, L) bool pairs with Cb distance < DMAX
+"""
+OUTPUTS = ["dis", "dis_angle"]
+MAX_TOKENS = 2**20
+
+def bin_index(v, segs):
+    """
+    index of the bin of v in segs, as the linear scans of get_*_class:
+    i if segs[i-1] < v < segs[i], len(segs) for v past the last edge,
+    on an edge, or NaN
+    """
+    v = np.asarray(v, dtype=np.float64)
+    idx = np.digitize(v, segs)
+    on_edge = np.isin(v, segs) | np.isnan(v)
+    return np.where(on_edge, len(segs), idx)
+
+def pad_batch(xyz_s, dtype=torch.float32):
+    """
+    list of (L, ...) arrays -> (B, Lmax, ...) NaN padded tensor
+    """
+    lmax = max([x.shape[0] for x in xyz_s])
+    out = torch.full((len(xyz_s), lmax) + tuple(xyz_s[0].shape[1:]), np.nan, dtype=dtype)
+    for i, x in enumerate(xyz_s):
+        out[i, :x.shape[0]] = torch.as_tensor(np.asarray(x), dtype=dtype)
+    return out
+
+def ca_dist(ca):
+    """
+    (B, L, 3) -> (B, L, L) float64 distances, computed like get_pdb_dis
+    """
+    ca = torch.as_tensor(ca, dtype=torch.float64)
+    return torch.sqrt(torch.sum((ca[:, None] - ca[:, :, None])**2, dim=-1))
+
+def c6d_bins(ncaccb_s, params=PARAMS):
+    """
+    binned 6D maps and masks of a list of (L, 4, 3) N,CA,C,Cb structures,
+    computed in one padded batch and cut back to every length
+    """
+    xyz = pad_batch(ncaccb_s)
+    c6d, mask = xyz_to_c6d(xyz, params=params)
+    bins = c6d_to_bins2(c6d, params=params).to(torch.uint8).numpy()
+    mask = mask.bool().numpy()
+    out = []
+    for i, x in enumerate(ncaccb_s):
+        L = x.shape[0]
+        out.append((bins[i, :L, :L], mask[i, :L, :L]))
+    return out
+
+def target_paths(out_base_dir, pdb_name):
+    d = os.path.join(out_base_dir, pdb_name)
+    return {"xyz": os.path.join(d, pdb_name + ".xyz.npy"),
+            "ncaccb": os.path.join(d, pdb_name + ".ncaccb.npy"),
+            "dis": os.path.join(d, pdb_name + ".dis"),
+            "dis_angle": os.path.join(d, pdb_name + ".dis_angle"),
+            "mask": os.path.join(d, pdb_name + ".mask")}
+
+def load_target(out_base_dir, pdb_name, outputs):
+    paths = target_paths(out_base_dir, pdb_name)
+    inputs = {}
+    if "dis" in outputs:
+        if not os.path.exists(paths["xyz"]):
+            return None
+        # CA of every residue, rows of (N, CA, C)
+        inputs["ca"] = np.load(paths["xyz"]).reshape(-1, 3, 3)[:, 1]
+    if "dis_angle" in outputs:
+        if not os.path.exists(paths["ncaccb"]):
+            return None
+        inputs["ncaccb"] = np.load(paths["ncaccb"]).reshape(-1, 4, 3)
+    return inputs
+
+def process_batch(out_base_dir, pdb_names, outputs=OUTPUTS):
+    targets = []
+    for pdb_name in pdb_names:
+        inputs = load_target(out_base_dir, pdb_name, outputs)
+        if inputs is None:
+            print("skip", pdb_name)
+            continue
+        targets.append((pdb_name, inputs))
+    if len(targets) == 0:
+        return 0
+    result = {name: {} for name, _ in targets}
+    if "dis" in outputs:
+        ca = pad_batch([t["ca"] for _, t in targets], dtype=torch.float64)
+        dis = ca_dist(ca).numpy()
+        for i, (name, t) in enumerate(targets):
+            L = t["ca"].shape[0]
+            result[name]["dis"] = dis[i, :L, :L]
+    if "dis_angle" in outputs:
+        bins = c6d_bins([t["ncaccb"] for _, t in targets])
+        for (name, _), (c6d, mask) in zip(targets, bins):
+            result[name]["dis_angle"] = c6d
+            result[name]["mask"] = mask
+    for name, out in result.items():
+        paths = target_paths(out_base_dir, name)
+        for k, v in out.items():
+            np.save(paths[k], v)
+    return len(targets)
+
+def target_length(out_base_dir, pdb_name, outputs):
+    paths = target_paths(out_base_dir, pdb_name)
+    fn = paths["ncaccb"] if "dis_angle" in outputs else paths["xyz"]
+    if not os.path.exists(fn):
+        return 0
+    shape = np.load(fn, mmap_mode="r").shape
+    # xyz rows hold N, CA, C (one residue per 9 values), ncaccb rows one residue
+    return int(np.prod(shape)) // 9 if fn == paths["xyz"] else shape[0]
+
+def make_batches(out_base_dir, pdb_names, outputs=OUTPUTS, max_tokens=MAX_TOKENS):
+    """
+    targets sorted by length, packed so that B * Lmax^2 stays within max_tokens
+    """
+    lens = [(target_length(out_base_dir, n, outputs), n) for n in pdb_names]
+    batches, batch, lmax = [], [], 0
+    for L, name in sorted(lens):
+        l = max(lmax, L)
+        if batch and (len(batch) + 1) * l * l > max_tokens:
+            batches.append(batch)
+            batch, l = [], L
+        batch.append(name)
+        lmax = l
+    if batch:
+        batches.append(batch)
+    return batches
+
+def _process_task(args):
+    out_base_dir, pdb_names, outputs = args
+    try:
+        return process_batch(out_base_dir, pdb_names, outputs), None
+    except Exception as e:
+        return 0, "%s: %s" % (pdb_names, e)
+
+def run(out_base_dir, pdb_list, n_cpu=1, outputs=OUTPUTS, max_tokens=MAX_TOKENS):
+    pdb_names = [line.strip().split('/')[-1].split(".")[0] for line in open(pdb_list) if line.strip()]
+    tasks = [(out_base_dir, b, outputs) for b in make_batches(out_base_dir, pdb_names, outputs, max_tokens)]
+    pool = Pool(n_cpu) if n_cpu > 1 else None
+    results = pool.imap_unordered(_process_task, tasks) if pool else map(_process_task, tasks)
+    done = 0
+    for n, err in results:
+        done += n
+        if err is not None:
+            print("error", err)
+    if pool:
+        pool.close()
+        pool.join()
+    print("labels written for %d/%d targets" % (done, len(pdb_names)))
+
+if __name__ == '__main__':
+    run(sys.argv[1], "train-pdb.list", int(sys.argv[2]))
@@ -0,0 +1,209 @@
+import sys
+import time
+import numpy as np
+"""
+Backbone reader for PDB and mmCIF files, without building a Biopython Structure.
+
+ATOM/HETATM records of the first model are cut into their fixed columns with
+numpy (mmCIF _atom_site rows are split on whitespace instead), and only N, CA
+and C are gathered per residue. Residues follow Biopython's order and
+selection: chains in order of appearance, residues in file order, only the
+residues with N, CA and C, of alternate locations the one with the highest
+occupancy and of point mutations the residue listed last.
+
+  xyz, resid = read_backbone("pdb/7C7R.pdb")
+  xyz    (L, 4, 3) float32 N, CA, C, ideal Cb
+  resid  (L,) residue numbers (residue.id[1] in Biopython)
+"""
+letters = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D', 'CYS': 'C', 'GLU': 'E', 'GLN': 'Q', 'GLY': 'G', 'HIS': 'H',
+           'ILE': 'I', 'LEU': 'L', 'LYS': 'K', 'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S', 'THR': 'T', 'TRP': 'W',
+           'TYR': 'Y', 'VAL': 'V'}
+BACKBONE = [b"N", b"CA", b"C"]
+PEPTIDE_BOND = 1.8
+
+def ideal_cb(ncac):
+    """
+    (..., 3, 3) N, CA, C -> (..., 3) ideal Cb
+    """
+    b = ncac[..., 1, :] - ncac[..., 0, :]
+    c = ncac[..., 2, :] - ncac[..., 1, :]
+    a = np.cross(b, c)
+    return -0.58273431*a + 0.56802827*b - 0.54067466*c + ncac[..., 1, :]
+
+def to_float32(col):
+    # through float64 like float() in Biopython, so coordinates round the same way
+    return col.astype(np.float64).astype(np.float32)
+
+def read_pdb_atoms(path):
+    """
+    atom records of the first model as arrays
+    """
+    with open(path, "rb") as fh:
+        data = fh.read()
+    end = data.find(b"\nENDMDL")
+    if end >= 0:
+        data = data[:end]
+    lines = [l for l in data.splitlines() if l[:6] == b"ATOM  " or l[:6] == b"HETATM"]
+    buf = np.array(lines, dtype="S80").view(np.uint8).reshape(len(lines), 80)
+    def col(b, e):
+        return np.ascontiguousarray(buf[:, b:e]).view("S%d" % (e - b)).reshape(-1)
+    occ = np.char.strip(col(54, 60))
+    return {
+        "name": np.char.strip(col(12, 16)),
+        # chain, resseq and icode
+        "key": col(21, 27),
+        "chain": col(21, 22),
+        "resname": np.char.strip(col(17, 20)),
+        "resseq": col(22, 26).astype(np.int64),
+        "xyz": to_float32(np.ascontiguousarray(buf[:, 30:54]).view("S8")).reshape(-1, 3),
+        "occ": np.where(occ == b"", b"1", occ).astype(np.float32),
+    }
+
+def read_cif_atoms(path):
+    """
+    _atom_site records of the first model as arrays, named as Biopython's
+    MMCIFParser reads them (label atom and residue names, author chain and
+    residue numbers)
+    """
+    with open(path, "rb") as fh:
+        lines = fh.read().splitlines()
+    header, rows = [], []
+    for line in lines:
+        if line.startswith(b"_atom_site."):
+            header.append(line.split()[0][len(b"_atom_site."):].decode())
+        elif header:
+            if line.startswith((b"#", b"loop_", b"_")):
+                break
+            rows.append(line)
+    if len(rows) == 0:
+        return None
+    # values never hold spaces in the columns used here
+    table = np.array(b" ".join(rows).split()).reshape(-1, len(header))
+    def col(name):
+        return table[:, header.index(name)]
+    if "pdbx_PDB_model_num" in header:
+        model = col("pdbx_PDB_model_num")
+        table = table[model == model[0]]
+    resseq = col("auth_seq_id" if "auth_seq_id" in header else "label_seq_id")
+    icode = col("pdbx_PDB_ins_code") if "pdbx_PDB_ins_code" in header else np.full(len(table), b"?")
+    chain = col("auth_asym_id")
+    resname = col("label_comp_id")
+    occ = col("occupancy")
+    return {
+        "name": np.char.strip(col("label_atom_id"), b'"'),
+        "key": np.char.add(np.char.add(np.char.add(chain, b" "), resseq), icode),
+        "chain": chain,
+        "resname": resname,
+        "resseq": resseq.astype(np.int64),
+        "xyz": to_float32(np.stack([col("Cartn_x"), col("Cartn_y"), col("Cartn_z")], axis=-1)),
+        "occ": np.where(np.isin(occ, [b"?", b"."]), b"1", occ).astype(np.float32),
+    }
+
+def read_atoms(path):
+    if path.endswith((".cif", ".mmcif")):
+        return read_cif_atoms(path)
+    return read_pdb_atoms(path)
+
+def residues(atoms):
+    """
+    (R, 3, 3) N, CA, C (NaN where missing), residue numbers, chains and residue
+    names of all residues, in the order Biopython iterates them
+    """
+    if atoms is None or len(atoms["key"]) == 0:
+        return np.zeros((0, 3, 3), dtype=np.float32), np.zeros(0, dtype=np.int64), \
+            np.zeros(0, dtype="S1"), np.zeros(0, dtype="S3")
+    key = atoms["key"]
+    _, first, rid = np.unique(key, return_index=True, return_inverse=True)
+    rid = rid.reshape(-1)
+    # of several residue names on one residue (point mutations) Biopython keeps the last
+    last = len(key) - 1 - np.unique(key[::-1], return_index=True)[1]
+    resname = atoms["resname"][last]
+    keep = atoms["resname"] == resname[rid]
+    # chains in order of appearance, then residues in file order
+    _, chain_first, chain_id = np.unique(atoms["chain"], return_index=True, return_inverse=True)
+    chain_rank = np.argsort(np.argsort(chain_first))[chain_id.reshape(-1)]
+    order = np.lexsort((first, chain_rank[first]))
+    xyz = np.full((len(first), 3, 3), np.nan, dtype=np.float32)
+    for k, name in enumerate(BACKBONE):
+        sel = np.where((atoms["name"] == name) & keep)[0]
+        # highest occupancy first, file order on ties
+        sel = sel[np.lexsort((sel, -atoms["occ"][sel], rid[sel]))]
+        res, pick = np.unique(rid[sel], return_index=True)
+        xyz[res, k] = atoms["xyz"][sel[pick]]
+    return xyz[order], atoms["resseq"][first[order]], atoms["chain"][first[order]], resname[order]
+
+def backbone(atoms):
+    """
+    (L, 4, 3) N, CA, C, Cb, residue numbers, chains and residue names of the
+    residues with N, CA and C
+    """
+    ncac, resid, chain, resname = residues(atoms)
+    ok = ~np.isnan(ncac).any(axis=(1, 2))
+    ncac = ncac[ok]
+    xyz = np.concatenate([ncac, ideal_cb(ncac)[:, None]], axis=1)
+    return xyz, resid[ok], chain[ok], resname[ok]
+
+def read_backbone(path):
+    """
+    (L, 4, 3) float32 N, CA, C, Cb and (L,) residue numbers of a PDB or mmCIF file
+    """
+    xyz, resid, _, _ = backbone(read_atoms(path))
+    return xyz, resid
+
+def peptide_sequence(ncac, chain, resname, radius=PEPTIDE_BOND):
+    """
+    sequence of the polypeptides among residues(), as PPBuilder().build_peptides:
+    runs of standard residues of one chain whose C and next N are within radius
+    """
+    std = np.isin(resname, [k.encode() for k in letters])
+    cn = np.linalg.norm(ncac[1:, 0] - ncac[:-1, 2], axis=-1)
+    link = std[:-1] & std[1:] & (chain[1:] == chain[:-1]) & (cn < radius)
+    keep = np.zeros(len(ncac), dtype=bool)
+    keep[:-1] |= link
+    keep[1:] |= link
+    return "".join([letters[r.decode()] for r in resname[keep]])
+
+def biopython_backbone(path):
+    """
+    the Biopython path of generate_ncaccb.pdb2coords2, for comparison
+    """
+    from Bio import PDB
+    parser = PDB.MMCIFParser(QUIET=True) if path.endswith((".cif", ".mmcif")) else PDB.PDBParser(QUIET=True)
+    model = parser.get_structure("tmp", path)[0]
+    coords, resid = [], []
+    for chain in model:
+        for residue in chain:
+            if "CA" not in residue or "N" not in residue or "C" not in residue:
+                continue
+            coords.append([residue[i].get_coord() for i in ["N", "CA", "C"]])
+            resid.append(residue.id[1])
+    ncac = np.array(coords, dtype=np.float32).reshape(-1, 3, 3)
+    return np.concatenate([ncac, ideal_cb(ncac)[:, None]], axis=1), np.array(resid, dtype=np.int64)
+
+def benchmark(paths, n_chains=2000):
+    """
+    time read_backbone against the Biopython path over at least n_chains chains
+    (paths are repeated as needed), checking that both give the same backbone
+    """
+    chains = []
+    for path in paths:
+        xyz, resid, chain, _ = backbone(read_atoms(path))
+        ref_xyz, ref_resid = biopython_backbone(path)
+        assert np.array_equal(resid, ref_resid) and np.array_equal(xyz, ref_xyz, equal_nan=True), path
+        chains.append(max(len(np.unique(chain)), 1))
+    paths = paths * -(-n_chains // sum(chains))
+    n = sum(chains) * (len(paths) // len(chains))
+    result = {}
+    for label, fn in [("biopython", biopython_backbone), ("pdb_reader", read_backbone)]:
+        t = time.time()
+        for path in paths:
+            fn(path)
+        result[label] = time.time() - t
+        print("%-10s %d files, %d chains: %.2fs, %.2f ms/chain" % (label, len(paths), n, result[label], 1000 * result[label] / n))
+    print("speedup %.1fx" % (result["biopython"] / result["pdb_reader"]))
+    return result
+
+if __name__ == '__main__':
+    # python pdb_reader.py [pdb or cif files]  (default: every pdb of train-pdb.list)
+    paths = sys.argv[1:] or [line.strip() for line in open("train-pdb.list") if line.strip()]
+    benchmark(paths)
@@ -0,0 +1,47 @@
+import os
+import numpy as np
+import label_engine
+"""
+label_engine against the labels stored for 7CWP in train-data, which the
+per-target generate_dis.py / generate_dis_angle.py scripts wrote.
+
+  python -m pytest test_label_engine.py
+"""
+REF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "train-data", "7CWP")
+NAME = "7CWP"
+
+def ref(kind):
+    return np.load(os.path.join(REF_DIR, "%s.%s.npy" % (NAME, kind)))
+
+def copy_inputs(out_base_dir, name, L=None):
+    d = os.path.join(out_base_dir, name)
+    os.makedirs(d)
+    xyz, ncaccb = ref("xyz"), ref("ncaccb")
+    if L is not None:
+        xyz, ncaccb = xyz[:L * 3], ncaccb[:L]
+    np.save(os.path.join(d, name + ".xyz.npy"), xyz)
+    np.save(os.path.join(d, name + ".ncaccb.npy"), ncaccb)
+
+def load_labels(out_base_dir, name):
+    paths = label_engine.target_paths(out_base_dir, name)
+    return {k: np.load(paths[k] + ".npy") for k in ["dis", "dis_angle", "mask"]}
+
+def check_labels(out, L):
+    ref_dis = ref("dis")[:L, :L]
+    assert out["dis"].shape == ref_dis.shape
+    np.testing.assert_allclose(out["dis"], ref_dis, rtol=1e-12, atol=1e-12, equal_nan=True)
+    assert np.array_equal(out["dis_angle"].astype(np.int64), ref("dis_angle")[:L, :L])
+    assert np.array_equal(out["mask"].astype(bool), ref("mask")[:L, :L].astype(bool))
+
+def test_7cwp(tmp_path):
+    copy_inputs(str(tmp_path), NAME)
+    assert label_engine.process_batch(str(tmp_path), [NAME]) == 1
+    check_labels(load_labels(str(tmp_path), NAME), ref("ncaccb").shape[0])
+
+def test_7cwp_padded_batch(tmp_path):
+    # a shorter target in the same batch pads 7CWP's neighbour, the labels must not change
+    copy_inputs(str(tmp_path), NAME)
+    copy_inputs(str(tmp_path), "short", L=60)
+    assert label_engine.process_batch(str(tmp_path), ["short", NAME]) == 2
+    check_labels(load_labels(str(tmp_path), NAME), ref("ncaccb").shape[0])
+    check_labels(load_labels(str(tmp_path), "short"), 60)
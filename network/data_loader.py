@@ -4,6 +4,8 @@ import numpy as np
 import torch
 from torch.utils import data
 import os
+from parsers import MSABin, msabin_path, msabin_is_fresh
+from kinematics import xyz_to_bins
 base_dir = "/projects/ml/TrRosetta/PDB30-20FEB17"
 base_torch_dir = base_dir
 if not os.path.exists(base_dir):
@@ -31,7 +33,8 @@ def set_data_loader_params(args):
         "ROWS"    : 1,
         "SUBSMP"  : "UNI",
         "seqID"   : 50.0,
-        "MAXTOKEN": 2**15
+        "MAXTOKEN": 2**15,
+        "LABELS"  : False
     }
     for param in PARAMS:
         if hasattr(args, param.lower()):
@@ -47,6 +50,7 @@ def msa_collate_fn(batch, params):
     #  - idx: raw residue index from pdb before cropping (L)
     # Outputs:
     #  - batched msa (B, N', L'), xyz (B, L', 3, 3), idx (B,L')
+    #  - with params['LABELS'] also dist, omega, theta, phi bins and mask (B, L', L') of the crop
 
     msa_s, xyz_s, idx_s, seqlen, depth = zip(*[[msa, xyz, idx, msa.shape[1], msa.shape[0]] for msa, xyz, idx in batch])
     L = min(seqlen)
@@ -79,9 +83,10 @@ def msa_collate_fn(batch, params):
                     sample = torch.randperm(depth[i_b]-1, device=device)[:n_sample]
                 else:
                     sample = torch.randperm(min(depth[i_b]-1, 100), device=device)[:n_sample]
-                tmp_msa = torch.cat([msa_s[i_b][:1,:], msa_s[i_b][1:,:][sample]], dim=0)
+                tmp_msa = msa_rows(msa_s[i_b], torch.cat([torch.zeros(1, dtype=sample.dtype, device=device), sample+1]))
             else:
-                tmp_msa = msa_s[i_b][:1,:]
+                tmp_msa = msa_rows(msa_s[i_b], slice(0, 1))
+        tmp_msa = msa_rows(tmp_msa)
         if seqlen[i_b] > L: # trim inputs to size L
             sel = get_crop(tmp_msa, L, params)
             #
@@ -97,6 +102,8 @@ def msa_collate_fn(batch, params):
     b_xyz = torch.stack(b_xyz, 0)
     b_idx = torch.stack(b_idx, 0)
 
+    if params.get('LABELS'):
+        return (b_msa, b_xyz, b_idx) + xyz_to_bins(b_xyz)
     return b_msa, b_xyz, b_idx
 
 def msa_infer_collate_fn(batch, params):
@@ -134,9 +141,10 @@ def msa_infer_collate_fn(batch, params):
         #
         if depth[i_b] > n_sample + 1: # should be subsampled
             if n_sample > 0:
-                tmp_msa = torch.cat([msa_s[i_b][:1,:], msa_s[i_b][1:n_sample+1,:]], dim=0)
+                tmp_msa = msa_rows(msa_s[i_b], slice(0, n_sample+1))
             else:
-                tmp_msa = msa_s[i_b][:1,:]
+                tmp_msa = msa_rows(msa_s[i_b], slice(0, 1))
+        tmp_msa = msa_rows(tmp_msa)
         if seqlen[i_b] > L: # trim inputs to size L
             sel = get_crop(tmp_msa, L, params)
             #
@@ -165,6 +173,7 @@ def tbm_collate_fn(batch, params):
     #  - t1d: raw 1D template features before cropping (T, L, 3)
     # Outputs:
     #  - batched msa (B, N', L'), xyz (B, L', 3, 3), idx (B,L')
+    #  - with params['LABELS'] also dist, omega, theta, phi bins and mask (B, L', L') of the crop
 
     msa_s, xyz_s, idx_s, xyz_t_s, t1d_s, t0d_s, seqlen, depth, tplt_s = zip(*[[msa, xyz, idx, xyz_t, t1d, t0d, msa.shape[1], msa.shape[0], xyz_t.shape[0]] for msa, xyz, idx, xyz_t, t1d, t0d in batch])
     L = min(seqlen)
@@ -216,9 +225,10 @@ def tbm_collate_fn(batch, params):
                     sample = torch.randperm(depth[i_b]-1, device=device)[:n_sample]
                 else:
                     sample = torch.randperm(min(depth[i_b]-1, 100), device=device)[:n_sample]
-                tmp_msa = torch.cat([msa_s[i_b][:1,:], msa_s[i_b][1:,:][sample]], dim=0)
+                tmp_msa = msa_rows(msa_s[i_b], torch.cat([torch.zeros(1, dtype=sample.dtype, device=device), sample+1]))
             else:
-                tmp_msa = msa_s[i_b][:1,:]
+                tmp_msa = msa_rows(msa_s[i_b], slice(0, 1))
+        tmp_msa = msa_rows(tmp_msa)
         if seqlen[i_b] > L: # trim inputs to size L
             sel = get_crop(tmp_msa, L, params)
             #
@@ -242,6 +252,8 @@ def tbm_collate_fn(batch, params):
     b_t1d = torch.stack(b_t1d, 0)
     b_t0d = torch.stack(b_t0d, 0)
 
+    if params.get('LABELS'):
+        return (b_msa, b_xyz, b_idx, b_xyz_t, b_t1d, b_t0d) + xyz_to_bins(b_xyz)
     return b_msa, b_xyz, b_idx, b_xyz_t, b_t1d, b_t0d
 
 def tbm_infer_collate_fn(batch, params):
@@ -291,9 +303,10 @@ def tbm_infer_collate_fn(batch, params):
         #
         if depth[i_b] > n_sample + 1: # should be subsampled
             if n_sample > 0:
-                tmp_msa = torch.cat([msa_s[i_b][:1,:], msa_s[i_b][1:n_sample+1,:]], dim=0)
+                tmp_msa = msa_rows(msa_s[i_b], slice(0, n_sample+1))
             else:
-                tmp_msa = msa_s[i_b][:1,:]
+                tmp_msa = msa_rows(msa_s[i_b], slice(0, 1))
+        tmp_msa = msa_rows(tmp_msa)
         if seqlen[i_b] > L: # trim inputs to size L
             sel = get_crop(tmp_msa, L, params)
             #
@@ -319,6 +332,14 @@ def tbm_infer_collate_fn(batch, params):
 
     return b_msa, b_xyz, b_idx, b_xyz_t, b_t1d, b_t0d
 
+def msa_rows(msa, rows=None):
+    # msa is a tensor or a parsers.MSABin, whose rows are only read here
+    if isinstance(msa, MSABin):
+        return torch.from_numpy(msa.rows(rows)).long()
+    if rows is None:
+        return msa
+    return msa[rows]
+
 def subsample_msa(nmin, nmax, method):
     # how many sequences to pick?
     if method == 'LOG':
@@ -392,17 +413,20 @@ def pick_templates(tplt, qlen, params, pick_top=False, seqID_cut=80.0):
 
     xyz = torch.full((npick,qlen,3,3),np.nan).float()
     f1d = torch.zeros((npick,qlen,3)).float()
-    f0d = list()
 
-    for i,nt in enumerate(sample):
-        sel = torch.where(tplt['qmap'][0,:,1]==nt)[0]
-        pos = tplt['qmap'][0,sel,0]
-        xyz[i,pos] = tplt['xyz'][0,sel,:3]
-        f1d[i,pos] = tplt['f1d'][0,sel,:3]
-        # 0-D features: HHprob, seqID, similarity
-        f0d.append(torch.stack([tplt['f0d'][0,nt,0]/100.0, tplt['f0d'][0,nt,4]/100.0, tplt['f0d'][0,nt,5]], dim=-1))
+    # output slot of every template (-1 if not picked), so all templates scatter at once
+    tid = tplt['qmap'][0,:,1].long()
+    slot = torch.full((max(ntplt, int(tid.max())+1 if len(tid) > 0 else 0),), -1, dtype=torch.long)
+    slot[sample] = torch.arange(npick)
+    sel = torch.where(slot[tid] >= 0)[0]
+    pos = tplt['qmap'][0,sel,0]
+    xyz[slot[tid[sel]],pos] = tplt['xyz'][0,sel,:3]
+    f1d[slot[tid[sel]],pos] = tplt['f1d'][0,sel,:3]
+    # 0-D features: HHprob, seqID, similarity
+    f0d = tplt['f0d'][0,sample]
+    f0d = torch.stack([f0d[:,0]/100.0, f0d[:,4]/100.0, f0d[:,5]], dim=-1)
 
-    return xyz,f1d,torch.stack(f0d, dim=0)
+    return xyz,f1d,f0d
 
 def get_train_valid_set(params):
     # read validation IDs
@@ -434,31 +458,53 @@ def get_train_valid_set(params):
     return train, valid
 
 
+def load_msabin(item, params):
+    # binary MSA (parsers.a3m_to_msabin) next to the a3m .pt, rows are read lazily in the collate fn
+    fn = msabin_path(params['DIR'], item[1])
+    if not os.path.exists(fn):
+        return None
+    msa = MSABin(fn)
+    if not msabin_is_fresh(msa.meta):
+        # the a3m changed after conversion, fall back to the .pt
+        print("stale msabin", fn)
+        return None
+    return msa
+
 def loader_tbm(item, params, pick_top=False, seqID=80.0):
 
     pdb = torch.load(params['DIR']+'/torch/pdb/'+item[0][1:3]+'/'+item[0]+'.pt')
-    a3m = torch.load(params['DIR']+'/torch/a3m/'+item[1][2:4]+'/'+item[1]+'.pt')
     tplt = torch.load(params['DIR']+'/torch/hhr/'+item[1][2:4]+'/'+item[1]+'.pt')
     idx = pdb['idx'][0]
 
-    l = a3m['msa'].shape[-1]
+    msabin = load_msabin(item, params)
+    if msabin is not None:
+        l = msabin.shape[-1]
+    else:
+        a3m = torch.load(params['DIR']+'/torch/a3m/'+item[1][2:4]+'/'+item[1]+'.pt')
+        l = a3m['msa'].shape[-1]
     xyz_t,f1d_t,f0d_t = pick_templates(tplt, l, params, pick_top=pick_top, seqID_cut=seqID)
 
     # trim to physically observed residues
-    msa = a3m['msa'][...,idx]
-    ins = a3m['ins'][...,idx]
+    if msabin is not None:
+        msa = msabin.select_cols(idx.numpy())
+    else:
+        msa = a3m['msa'][...,idx][0]
+        ins = a3m['ins'][...,idx]
     xyz_t = xyz_t[:,idx]
     f1d_t = f1d_t[:,idx]
 
-    return msa[0], pdb['xyz'][0,:,:3], idx, xyz_t, f1d_t, f0d_t
+    return msa, pdb['xyz'][0,:,:3], idx, xyz_t, f1d_t, f0d_t
 
 def loader_msa(item, params, pick_top=False):
 
     pdb = torch.load(params['DIR']+'/torch/pdb/'+item[0][1:3]+'/'+item[0]+'.pt')
-    a3m = torch.load(params['DIR']+'/torch/a3m/'+item[1][2:4]+'/'+item[1]+'.pt')
     idx = pdb['idx'][0]
 
     # trim to physically observed residues
+    msabin = load_msabin(item, params)
+    if msabin is not None:
+        return msabin.select_cols(idx.numpy()), pdb['xyz'][0,:,:3], idx
+    a3m = torch.load(params['DIR']+'/torch/a3m/'+item[1][2:4]+'/'+item[1]+'.pt')
     msa = a3m['msa'][...,idx]
 
     return msa[0], pdb['xyz'][0,:,:3], idx
@@ -1,7 +1,9 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import numpy as np
 import pickle
+from train_store import TrainStore, is_train_store
+from lddt_torch import neighbor_list
 
 def read_data_true_mask(data_path):
     f = open(data_path, "rb")
@@ -16,137 +18,168 @@ def read_data_true_mask(data_path):
         # print(f"data shape {feat_new[0].shape}", )
         label_new = []
         label_new.append(torch.tensor(label[0]).float()) # xyz
-        label_new.extend([torch.tensor(i).long() for i in label[1:]])
+        label_new.extend([torch.tensor(i).to(torch.uint8) for i in label[1:]])
 
-        masks_new = torch.tensor(masks).long()
+        masks_new = torch.tensor(masks).bool()
         train_data.append((tuple(feat_new), tuple(label_new), masks_new))
     f.close()
     print("data reader over")
     return train_data
 
-def collate_batch_data(batch_dic):
+def collate_batch_data(batch_dic, pin_memory=False, lddt_cutoff=None):
+    """
+    pad a list of (feat, label, masks) samples into batch tensors
+
+    Every batch tensor is allocated once at its final shape (page-locked with
+    pin_memory=True, main process only) and filled sample by sample.
+    Returns feat, label, masks, lengths, pad_mask: lengths (B, 2) holds the
+    msa depth and length of every sample, pad_mask (B, L) is True on real
+    residues. With lddt_cutoff the lddt_torch.neighbor_list of the true CA
+    is returned as well, built here once instead of in every loss call.
+    """
+    B = len(batch_dic)
+    max_msa_len = max([feat[0].shape[0] for feat, label, masks in batch_dic]) # 一批数据中最深的那个msa
     max_seq_length = max([feat[0].shape[1] for feat, label, masks in batch_dic]) # 一批数据中最长的那个样本长度
-    max_msa_len = max([feat[0].shape[0] for feat, label, masks in batch_dic]) # 一批数据中最长的那个样本长度
+    max_templ = max([feat[1].shape[0] for feat, label, masks in batch_dic])
     # print(f"collate_batch_data max_msa_len {max_msa_len} max_seq_length {max_seq_length}")
 
-    def feat_extend(feat):
-        msa, xyz_t, t1d, t0d = feat
-
-        msa_new = np.full((max_msa_len, max_seq_length), 20)
-        msa_new[:msa.shape[0], :msa.shape[1]] = msa
-
-        xyz_new = np.full((10, max_seq_length, 3, 3), np.nan)
-        xyz_new[:,:xyz_t.shape[1]] = xyz_t
-
-        t1d_new = np.full((10, max_seq_length, 3), np.nan)
-        t1d_new[:,:t1d.shape[1]] = t1d
-
-        t0d = t0d.numpy()
-
-        return (msa_new, xyz_new, t1d_new, t0d)
-    def label_extend(labels):
-        """
-        xyz
-        dis
-        oemga
-        theta
-        phi
-        """
-        xyz_label, dis_label, omege_label, theta_label, phi_label = labels
-        cur_seq_len = omege_label.shape[0]
-        # print("debug", xyz_label.shape,omege_label.shape)
-
-        xyz_new_label = np.full((max_seq_length * 3, 3), np.nan)
-        xyz_new_label[:cur_seq_len * 3] = xyz_label
-
-        dis_new_label = np.full((max_seq_length, max_seq_length), 0)
-        dis_new_label[:cur_seq_len, :cur_seq_len] = dis_label 
-
-        omega_new_label = np.full((max_seq_length, max_seq_length), 0)
-        omega_new_label[:cur_seq_len, :cur_seq_len] = omege_label 
-
-        theta_new_label = np.full((max_seq_length, max_seq_length), 0)
-        theta_new_label[:cur_seq_len, :cur_seq_len] = theta_label
-
-        phi_new_label = np.full((max_seq_length, max_seq_length), 0)
-        phi_new_label[:cur_seq_len, :cur_seq_len] = phi_label
-        return [xyz_new_label, dis_new_label, omega_new_label, theta_new_label, phi_new_label]
-
-    def masks_extend(masks):
-        mask_new = np.full((max_seq_length, max_seq_length), 0.0)
-        cur_seq_len = masks.shape[0]
-        mask_new[:cur_seq_len, :cur_seq_len] = masks 
-        return mask_new
-
-    def split_feats(feats):
-        msas = []
-        xyz_ts = []
-        t1ds = []
-        t0ds = []
-        for msa, xyz_t, t1d, t0d in feats:
-            msas.append(msa)
-            xyz_ts.append(xyz_t)
-            t1ds.append(t1d)
-            t0ds.append(t0d)
-        msas = torch.tensor(msas).long()
-        xyz_ts = torch.tensor(xyz_ts).float()
-        t1ds = torch.tensor(t1ds).float()
-        t0ds = torch.tensor(t0ds).float()
-        return msas, xyz_ts, t1ds, t0ds
-    def split_labels(labels):
-        xyz_labels, dis_labels, omege_labels, theta_labels, phi_labels = [],[],[],[],[]
-        for xyz_label, dis_label, omege_label, theta_label, phi_label in labels:
-            xyz_labels.append(xyz_label)
-            dis_labels.append(dis_label)
-            omege_labels.append(omege_label)
-            theta_labels.append(theta_label)
-            phi_labels.append(phi_label)
-
-        xyz_labels = torch.tensor(xyz_labels).float()
-        dis_labels = torch.tensor(dis_labels).long()
-        omege_labels = torch.tensor(omege_labels).long()
-        theta_labels = torch.tensor(theta_labels).long()
-        phi_labels = torch.tensor(phi_labels).long()
-
-        return xyz_labels, dis_labels, omege_labels, theta_labels, phi_labels
-
-    feat_batch=[]
-    label_batch=[]
-    masks_batch=[]
-    for i in range(len(batch_dic)): 
-        feat, label, masks = batch_dic[i]
-        # msa, xyz_t, t1d, t0d = feat
-        feat = feat_extend(feat)
-        label = label_extend(label)
-
-        feat_batch.append(feat)
-        label_batch.append(label)
-        masks = masks_extend(masks)
-        masks_batch.append(masks)
-    feat_batch = split_feats(feat_batch)
-    label_batch = split_labels(label_batch)
-    masks_batch = torch.tensor(masks_batch)
-    return feat_batch, label_batch, masks_batch
+    def alloc(shape, like, fill):
+        t = torch.empty(shape, dtype=torch.as_tensor(like).dtype, pin_memory=pin_memory)
+        return t.fill_(fill)
+
+    feat0, label0, masks0 = batch_dic[0]
+    L = max_seq_length
+    msa, xyz_t, t1d, t0d = feat0[:4]
+    msa_b = alloc((B, max_msa_len, L), msa, 20)
+    xyz_t_b = alloc((B, max_templ, L, 3, 3), xyz_t, np.nan)
+    t1d_b = alloc((B, max_templ, L, 3), t1d, 0)
+    t0d_b = alloc((B, max_templ, 3), t0d, 0)
+    # xyz, dis, omega, theta, phi
+    label_b = [alloc((B, L * 3, 3), label0[0], np.nan)] + [alloc((B, L, L), l, 0) for l in label0[1:]]
+    masks_b = alloc((B, L, L), masks0, 0)
+    lengths = torch.zeros((B, 2), dtype=torch.long)
+
+    for i, (feat, label, masks) in enumerate(batch_dic):
+        msa, xyz_t, t1d, t0d = [torch.as_tensor(f) for f in feat[:4]]
+        n, l = msa.shape
+        nt = xyz_t.shape[0]
+        lengths[i, 0], lengths[i, 1] = n, l
+        msa_b[i, :n, :l] = msa
+        xyz_t_b[i, :nt, :l] = xyz_t
+        t1d_b[i, :nt, :l] = t1d
+        t0d_b[i, :nt] = t0d
+        label_b[0][i, :l * 3] = torch.as_tensor(label[0])
+        for j in range(1, len(label_b)):
+            label_b[j][i, :l, :l] = torch.as_tensor(label[j])
+        masks_b[i, :l, :l] = torch.as_tensor(masks)
+    pad_mask = torch.arange(L)[None] < lengths[:, 1:]
+    batch = (msa_b, xyz_t_b, t1d_b, t0d_b), tuple(label_b), masks_b, lengths, pad_mask
+    if lddt_cutoff is None:
+        return batch
+    neighbors = neighbor_list(label_b[0].view(B, L, 3, 3)[:, :, 1].float(), lddt_cutoff, chunk=128)
+    if pin_memory:
+        neighbors = tuple([n.pin_memory() for n in neighbors])
+    return batch + (neighbors,)
 
 class DataRead(Dataset):
-    def __init__(self, data_path) -> None:
+    def __init__(self, data_path, crop=None) -> None:
         super().__init__()
         # self.data = read_data_true(data_path)
-        self.data = read_data_true_mask(data_path)
-        pass
+        if is_train_store(data_path):
+            # samples are mapped from the shards on demand
+            self.data = TrainStore(data_path, crop=crop)
+        else:
+            self.data = read_data_true_mask(data_path)
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, index):
         return self.data[index]
 
+    def sizes(self):
+        """
+        (n, 2) msa depth and length of every sample
+        """
+        if isinstance(self.data, TrainStore):
+            return self.data.sizes()
+        return np.array([feat[0].shape for feat, label, masks in self.data], dtype=np.int64).reshape(-1, 2)
+
+class TokenBucketSampler(Sampler):
+    """
+    Batches of samples of similar length and msa depth, packed so that the
+    padded batch (B x max N x max L, as collate_batch_data pads it) stays within
+    max_tokens. Samples are shuffled within a bucket and batches across buckets
+    every epoch; a sample over the budget on its own makes a batch of one.
+
+    The batches depend only on seed and epoch, and iterating does not change
+    the sampler, so the trainer moves to the next epoch with set_epoch().
+    """
+    def __init__(self, sizes, max_tokens=2**15, len_bucket=16, depth_bucket=64, max_batch=None, shuffle=True, seed=0):
+        self.sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+        self.max_tokens = max_tokens
+        self.len_bucket = len_bucket
+        self.depth_bucket = depth_bucket
+        self.max_batch = max_batch
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def batches(self):
+        if self._batches is not None:
+            return self._batches
+        rng = np.random.RandomState(self.seed + self.epoch)
+        depth, length = self.sizes[:,0], self.sizes[:,1]
+        order = rng.permutation(len(self.sizes)) if self.shuffle else np.arange(len(self.sizes))
+        # stable sort keeps the shuffled order inside a bucket
+        key = (length[order] // self.len_bucket) * (depth.max(initial=0) // self.depth_bucket + 1) + depth[order] // self.depth_bucket
+        order = order[np.argsort(key, kind="stable")]
+
+        batches, batch, max_n, max_l = [], [], 0, 0
+        for i in order:
+            n, l = max(max_n, depth[i]), max(max_l, length[i])
+            full = self.max_batch is not None and len(batch) >= self.max_batch
+            if batch and (full or (len(batch) + 1) * n * l > self.max_tokens):
+                batches.append(batch)
+                batch, n, l = [], depth[i], length[i]
+            batch.append(int(i))
+            max_n, max_l = n, l
+        if batch:
+            batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        self._batches = batches
+        return batches
+
+    def padding_overhead(self, batches=None):
+        """
+        fraction of the padded msa tokens of an epoch that are padding
+        """
+        batches = self.batches() if batches is None else batches
+        real, padded = 0, 0
+        for b in batches:
+            n, l = self.sizes[b,0], self.sizes[b,1]
+            real += int((n * l).sum())
+            padded += len(b) * int(n.max()) * int(l.max())
+        return 1.0 - real / max(padded, 1)
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
 
 def test_dataloader():
-    train_data = DataRead("./generate_feat/train_data.pickle")
+    train_data = DataRead("./generate_feat/train_store")
     dataloader = torch.utils.data.DataLoader(train_data, batch_size=2, shuffle=True, collate_fn=collate_batch_data)
     for i, data in enumerate(dataloader):
         # print(data)
-        feat, label, masks = data
-        print(len(feat[0]))
+        feat, label, masks, lengths, pad_mask = data
+        print(len(feat[0]), lengths.tolist())
 if __name__ == '__main__':
     test_dataloader()
\ No newline at end of file
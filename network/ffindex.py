@@ -8,9 +8,13 @@ Created on Apr 30, 2014
 '''
 
 
+import os
 import sys
 import mmap
+import hashlib
 from collections import namedtuple
+import numpy as np
+import mmap_store
 
 FFindexEntry = namedtuple("FFindexEntry", "name, offset, length")
 
@@ -42,6 +46,8 @@ def read_data(ffdata_filename):
 
 
 def get_entry_by_name(name, index):
+    if isinstance(index, FFindexDB):
+        return index.get(name)
     # f_dict = get_ffdb_dict(index)
     # if name in f_dict:
     #     return f_dict[name]
@@ -53,6 +59,172 @@ def get_entry_by_name(name, index):
     return None
 
 
+_ffdata_cache = {}
+def read_data_shared(ffdata_filename):
+    # one read-only mmap per .ffdata, shared by every FFindexDB in the process
+    key = os.path.realpath(ffdata_filename)
+    if key not in _ffdata_cache:
+        _ffdata_cache[key] = read_data(ffdata_filename)
+    return _ffdata_cache[key]
+
+
+def read_index_arrays(ffindex_filename):
+    with open(ffindex_filename, "rb") as fh:
+        lines = fh.read().split(b"\n")
+    tokens = [l.split(b"\t") for l in lines if l]
+    if len(tokens) == 0:
+        return np.zeros(0, dtype="S1"), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    names, offsets, lengths = zip(*[t[:3] for t in tokens])
+    names = np.array(names)
+    offsets = np.array(offsets).astype(np.int64)
+    lengths = np.array([l.strip() for l in lengths]).astype(np.int64)
+    return names, offsets, lengths
+
+
+def search_sorted_names(sorted_names, names):
+    '''
+    Binary search of `names` in a sorted fixed-width bytes array, -1 if missing
+    '''
+    query = np.array([n.encode("utf-8") if isinstance(n, str) else n for n in names], dtype=bytes)
+    if query.shape[0] == 0 or sorted_names.shape[0] == 0:
+        return np.full(query.shape[0], -1, dtype=np.int64)
+    too_long = np.char.str_len(query) > sorted_names.dtype.itemsize
+    query = query.astype(sorted_names.dtype)
+    pos = np.searchsorted(sorted_names, query)
+    pos = np.minimum(pos, sorted_names.shape[0] - 1)
+    found = (sorted_names[pos] == query) & ~too_long
+    return np.where(found, pos, -1)
+
+
+class FFindexDB:
+    '''
+    Read-only ffindex database with the index kept sorted in flat arrays:
+    names in one fixed-width byte buffer, offsets/lengths as int64 columns.
+    Lookups are a binary search instead of a scan over FFindexEntry tuples,
+    and the .ffdata mmap is shared between all databases opened on it.
+    '''
+    _cache = {}
+
+    def __init__(self, ffindex_filename, ffdata_filename, arrays=None, presorted=False):
+        if arrays is None:
+            arrays = load_index_sidecar(ffindex_filename)
+            presorted = arrays is not None
+        if arrays is None:
+            arrays = read_index_arrays(ffindex_filename)
+        names, offsets, lengths = arrays
+        if not presorted:
+            # stable sort so that duplicated names resolve to the first one in the file
+            order = np.argsort(names, kind="stable")
+            names, offsets, lengths = names[order], offsets[order], lengths[order]
+        self.names = np.ascontiguousarray(names)
+        self.offsets = np.ascontiguousarray(offsets)
+        self.lengths = np.ascontiguousarray(lengths)
+        self.ffindex_filename = ffindex_filename
+        self.ffdata_filename = ffdata_filename
+        self.data = read_data_shared(ffdata_filename)
+
+    @classmethod
+    def open(cls, ffindex_filename, ffdata_filename):
+        '''
+        Return the database for this index/data pair, loading it only once per process
+        '''
+        key = (os.path.realpath(ffindex_filename), os.path.realpath(ffdata_filename))
+        if key not in cls._cache:
+            cls._cache[key] = cls(ffindex_filename, ffdata_filename)
+        return cls._cache[key]
+
+    @property
+    def index(self):
+        # drop-in for the old namedtuple("FFindexDB", "index, data")
+        return self
+
+    def __len__(self):
+        return self.names.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.entry(i)
+
+    def __contains__(self, name):
+        return self.find(name) >= 0
+
+    def entry(self, i):
+        return FFindexEntry(self.names[i].decode("utf-8"), int(self.offsets[i]), int(self.lengths[i]))
+
+    def lookup(self, names):
+        '''
+        Vectorized search, returns the row of every name in `names` (-1 if missing)
+        '''
+        return search_sorted_names(self.names, names)
+
+    def find(self, name):
+        return int(self.lookup([name])[0])
+
+    def get(self, name):
+        i = self.find(name)
+        if i < 0:
+            return None
+        return self.entry(i)
+
+
+def file_checksum(filename, blocksize=1<<24):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as fh:
+        for block in iter(lambda: fh.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def sidecar_filename(ffindex_filename):
+    return ffindex_filename + ".bin"
+
+
+def build_index_sidecar(ffindex_filename, out_filename=None):
+    '''
+    Convert a text .ffindex into a sorted binary sidecar that load_index_sidecar
+    maps without parsing. The source size/mtime/checksum is stored to detect staleness.
+    '''
+    if out_filename is None:
+        out_filename = sidecar_filename(ffindex_filename)
+    st = os.stat(ffindex_filename)
+    names, offsets, lengths = read_index_arrays(ffindex_filename)
+    order = np.argsort(names, kind="stable")
+    meta = {"source_size": st.st_size,
+            "source_mtime_ns": st.st_mtime_ns,
+            "source_checksum": file_checksum(ffindex_filename)}
+    # write to a temporary name first so that readers never see a half-written sidecar
+    tmp_filename = out_filename + ".tmp%d" % os.getpid()
+    mmap_store.write_arrays(tmp_filename, {"names": names[order],
+                                           "offsets": offsets[order],
+                                           "lengths": lengths[order]}, meta)
+    os.replace(tmp_filename, out_filename)
+    return out_filename
+
+
+def load_index_sidecar(ffindex_filename, sidecar=None):
+    '''
+    Map the binary sidecar of `ffindex_filename`.
+    Returns (names, offsets, lengths) sorted by name, or None if missing or stale.
+    '''
+    if sidecar is None:
+        sidecar = sidecar_filename(ffindex_filename)
+    if not os.path.exists(sidecar):
+        return None
+    try:
+        arrays, meta = mmap_store.map_arrays(sidecar)
+    except (ValueError, KeyError):
+        return None
+    st = os.stat(ffindex_filename)
+    stale = st.st_size != meta.get("source_size")
+    if not stale and st.st_mtime_ns != meta.get("source_mtime_ns"):
+        # touched or copied: only trust the sidecar if the content is unchanged
+        stale = file_checksum(ffindex_filename) != meta.get("source_checksum")
+    if stale:
+        print("WARNING: %s is stale, parsing %s" % (sidecar, ffindex_filename))
+        return None
+    return arrays["names"], arrays["offsets"], arrays["lengths"]
+
+
 def read_entry_lines(entry, data):
     lines = data[entry.offset:entry.offset + entry.length - 1].decode("utf-8").split("\n")
     return lines
@@ -100,3 +272,9 @@ def write_entry_to_file(entry, data, file):
     for line in lines:
         fh.write(line+"\n")
     fh.close()
+
+
+if __name__ == '__main__':
+    # build binary index sidecars: python ffindex.py db_pdb.ffindex [...]
+    for ffindex_filename in sys.argv[1:]:
+        print("build", build_index_sidecar(ffindex_filename))
@@ -0,0 +1,87 @@
+'''
+Array-backed table of HHsearch hits read from a .hhr and its .atab in one pass each.
+
+  names   hit names, in file order
+  stats   record array of per-hit statistics from the .hhr
+          (prob, evalue, score, aligned_cols, identities, similarity, sum_probs, template_neff)
+  start   (nhit+1,) offsets of every hit into the aligned columns
+  qpos    query position of every aligned column (1-based, as in the .atab)
+  tpos    template position of every aligned column (1-based)
+  scores  (ncol, 3) per-column score, SS and probab from the .atab
+'''
+import numpy as np
+
+HHR_STATS = ["prob", "evalue", "score", "aligned_cols", "identities", "similarity", "sum_probs", "template_neff"]
+HHR_STATS_DTYPE = np.dtype([(k, np.float64) for k in HHR_STATS])
+
+class HitTable:
+    def __init__(self, names, stats, start, qpos, tpos, scores):
+        self.names = names
+        self.stats = stats
+        self.start = start
+        self.qpos = qpos
+        self.tpos = tpos
+        self.scores = scores
+        self.index = {}
+        for i, name in enumerate(names):
+            self.index.setdefault(name, i)
+
+    def __len__(self):
+        return len(self.names)
+
+    def stats_array(self):
+        # (nhit, 8) float view of the statistics, columns in HHR_STATS order
+        return self.stats.view(np.float64).reshape(-1, len(HHR_STATS))
+
+    def hit(self, key):
+        '''
+        qpos, tpos and scores of one hit, by position or by name
+        '''
+        i = self.index[key] if isinstance(key, str) else key
+        b, e = self.start[i], self.start[i+1]
+        return self.qpos[b:e], self.tpos[b:e], self.scores[b:e]
+
+def read_atab(atab_fn):
+    names, start, cols = [], [], []
+    with open(atab_fn, "rb") as fh:
+        for l in fh:
+            if l[:1] == b">":
+                names.append(l[1:].split()[0].decode("utf-8"))
+                start.append(len(cols))
+            elif b"score" in l or b"dssp" in l or not l.strip():
+                continue
+            else:
+                cols.append(l.split()[:5])
+    start.append(len(cols))
+    if len(cols) == 0:
+        cols = np.zeros((0, 5), dtype=bytes)
+    cols = np.array(cols, dtype=bytes)
+    qpos = cols[:, 0].astype(np.int64)
+    tpos = cols[:, 1].astype(np.int64)
+    scores = cols[:, 2:5].astype(np.float64)
+    return names, np.array(start, dtype=np.int64), qpos, tpos, scores
+
+def read_hhr_stats(hhr_fn):
+    names, stats = [], []
+    with open(hhr_fn, "r") as fh:
+        for l in fh:
+            if l[:1] != ">":
+                continue
+            names.append(l[1:].split()[0])
+            # Probab=.. E-value=.. Score=.. Aligned_cols=.. Identities=..% Similarity=.. Sum_probs=.. Template_Neff=..
+            stat = next(fh).replace("=", " ").replace("%", " ").split()[1::2]
+            stats.append(tuple(float(s) for s in stat[:len(HHR_STATS)]))
+    return names, np.array(stats, dtype=HHR_STATS_DTYPE).view(np.recarray)
+
+def parse_hits(hhr_fn, atab_fn):
+    '''
+    Read the hits of an HHsearch run, checking that .hhr and .atab list the same hits
+    '''
+    names, start, qpos, tpos, scores = read_atab(atab_fn)
+    hhr_names, stats = read_hhr_stats(hhr_fn)
+    if hhr_names != names:
+        if len(hhr_names) != len(names):
+            raise ValueError("%s has %d hits but %s has %d" % (hhr_fn, len(hhr_names), atab_fn, len(names)))
+        i = [a == b for a, b in zip(hhr_names, names)].index(False)
+        raise ValueError("hit %d is %s in %s but %s in %s" % (i, hhr_names[i], hhr_fn, names[i], atab_fn))
+    return HitTable(names, stats, start, qpos, tpos, scores)
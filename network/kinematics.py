@@ -85,6 +85,7 @@ def xyz_to_c6d(xyz, params=PARAMS):
     ----------
     xyz : pytorch tensor of shape [batch,nres,3,3]
           stores Cartesian coordinates of backbone N,Ca,C atoms
+          (or [batch,nres,4,3] with a given Cb as 4th atom)
     Returns
     -------
     c6d : pytorch tensor of shape [batch,nres,nres,4]
@@ -100,10 +101,13 @@ def xyz_to_c6d(xyz, params=PARAMS):
     C  = xyz[:,:,2]
 
     # recreate Cb given N,Ca,C
-    b = Ca - N
-    c = C - Ca
-    a = torch.cross(b, c, dim=-1)
-    Cb = -0.58273431*a + 0.56802827*b - 0.54067466*c + Ca    
+    if xyz.shape[2] > 3:
+        Cb = xyz[:,:,3]
+    else:
+        b = Ca - N
+        c = C - Ca
+        a = torch.cross(b, c, dim=-1)
+        Cb = -0.58273431*a + 0.56802827*b - 0.54067466*c + Ca    
 
     # 6d coordinates order: (dist,omega,theta,phi)
     c6d = torch.zeros([batch,nres,nres,4],dtype=xyz.dtype,device=xyz.device)
@@ -214,3 +218,18 @@ def c6d_to_bins2(c6d,params=PARAMS):
     pb[db==params['DBINS']] = params['ABINS']//2
     
     return torch.stack([db,ob,tb,pb],axis=-1).long()
+
+def xyz_to_bins(xyz, params=PARAMS):
+    """binned dist, omega, theta, phi maps and their mask
+    
+    Parameters
+    ----------
+    xyz : pytorch tensor of shape [batch,nres,3,3] (or [batch,nres,4,3] N,Ca,C,Cb)
+    Returns
+    -------
+    dist, omega, theta, phi : uint8 tensors of shape [batch,nres,nres]
+    mask : bool tensor of shape [batch,nres,nres], True where the pair is in contact
+    """
+    c6d, mask = xyz_to_c6d(xyz, params=params)
+    bins = c6d_to_bins2(c6d, params=params).to(torch.uint8)
+    return bins[...,0], bins[...,1], bins[...,2], bins[...,3], mask.bool()
@@ -16,11 +16,36 @@
 # import numpy as jnp
 import torch as jnp
 from torch.nn.modules.loss import MSELoss
+from torch.utils.checkpoint import checkpoint
+
+def dist_rows(points, i0, i1):
+    """(batch, i1 - i0, length) distances of points[:, i0:i1] to all points."""
+    return jnp.sqrt(1e-10 + jnp.sum((points[:, i0:i1, None] - points[:, None, :])**2, axis=-1))
+
+def map_rows(fn, length, chunk, *args):
+    """Concatenate fn(i0, i1, *args) over chunks of `chunk` rows along axis 1.
+
+    Only one chunk of (batch, chunk, length, ...) intermediates is alive at a
+    time: when the result needs gradients every chunk is checkpointed and
+    recomputed in the backward pass, so the gradients are the same as of the
+    unchunked computation.
+    """
+    chunk = length if chunk is None else max(int(chunk), 1)
+    grad = jnp.is_grad_enabled() and any([jnp.is_tensor(a) and a.requires_grad for a in args])
+    out = []
+    for i0 in range(0, length, chunk):
+        i1 = min(i0 + chunk, length)
+        if grad and chunk < length:
+            out.append(checkpoint(fn, i0, i1, *args, use_reentrant=False))
+        else:
+            out.append(fn(i0, i1, *args))
+    return jnp.cat(out, dim=1)
 
 def lddt(predicted_points,
                  true_points,
                  cutoff=20.,
-                 per_residue=False):
+                 per_residue=False,
+                 chunk=None):
     """Measure (approximate) lDDT for a batch of coordinates.
 
     lDDT reference:
@@ -46,39 +71,97 @@ def lddt(predicted_points,
         per_residue: If true, return score for each residue.    Note that the overall
             lDDT is not exactly the mean of the per_residue lDDT's because some
             residues have more contacts than others.
+        chunk: Number of residues whose distances are computed at a time, None
+            for all of them.    Memory grows as chunk * length instead of length^2.
 
     Returns:
         An (approximate, see above) lDDT score in the range 0-1.
     """
 
-    # Compute true and predicted distance matrices.
-    dmat_true = jnp.sqrt(1e-10 + jnp.sum((true_points[:, :, None] - true_points[:, None, :])**2, axis=-1))
+    length = true_points.shape[1]
 
-    dmat_predicted = jnp.sqrt(1e-10 + jnp.sum(
-            (predicted_points[:, :, None] -
-             predicted_points[:, None, :])**2, axis=-1))
+    def rows(i0, i1, predicted_points, true_points):
+        # Compute rows i0:i1 of the true and predicted distance matrices.
+        dmat_true = dist_rows(true_points, i0, i1)
+        dmat_predicted = dist_rows(predicted_points, i0, i1)
 
-    dists_to_score = (
-            (dmat_true < cutoff).float() * \
-            (1. - jnp.eye(dmat_true.shape[1]))    # Exclude self-interaction.
-    )
+        dists_to_score = (
+                (dmat_true < cutoff).float() * \
+                (1. - jnp.eye(length, device=dmat_true.device)[i0:i1])    # Exclude self-interaction.
+        )
 
-    # Shift unscored distances to be far away.
-    dist_l1 = jnp.abs(dmat_true - dmat_predicted)
+        # Shift unscored distances to be far away.
+        dist_l1 = jnp.abs(dmat_true - dmat_predicted)
+
+        # True lDDT uses a number of fixed bins.
+        # We ignore the physical plausibility correction to lDDT, though.
+        score = 0.25 * ((dist_l1 < 0.5).float()   +
+                                        (dist_l1 < 1.0).float()   +
+                                        (dist_l1 < 2.0).float()   +
+                                        (dist_l1 < 4.0).float()  )
+        return jnp.stack([jnp.sum(dists_to_score, axis=-1), jnp.sum(dists_to_score * score, axis=-1)], dim=-1)
+
+    # (batch, length, 2) number of scored pairs and their score, per residue
+    sums = map_rows(rows, length, chunk, predicted_points, true_points)
+    return normalize(sums, per_residue)
+
+def normalize(sums, per_residue):
+    """lDDT from (batch, length, 2) per residue pair counts and score sums."""
+    # Normalize over the appropriate axes.
+    if not per_residue:
+        sums = jnp.sum(sums, axis=1)
+    norm = 1. / (1e-10 + sums[..., 0])
+    score = norm * (1e-10 + sums[..., 1])
+
+    return score
+
+def neighbor_list(true_points, cutoff=20., chunk=None):
+    """Pairs scored by lddt, for lddt_sparse.
 
+    Args:
+        true_points: (batch, length, 3) array of true 3D points
+        cutoff: Maximum distance for a pair of points to be included
+        chunk: Number of residues whose distances are computed at a time
+
+    Returns:
+        pairs: (n_pairs, 3) long array of (batch, i, j), i != j, of the pairs
+            closer than cutoff in the true structure
+        dist: (n_pairs,) true distance of every pair
+    """
+    batch, length = true_points.shape[:2]
+    chunk = length if chunk is None else max(int(chunk), 1)
+    pairs, dist = [], []
+    with jnp.no_grad():
+        for i0 in range(0, length, chunk):
+            i1 = min(i0 + chunk, length)
+            dmat_true = dist_rows(true_points, i0, i1)
+            sel = (dmat_true < cutoff) & \
+                (1. - jnp.eye(length, device=dmat_true.device)[i0:i1]).bool()
+            b, i, j = jnp.nonzero(sel, as_tuple=True)
+            pairs.append(jnp.stack([b, i + i0, j], dim=-1))
+            dist.append(dmat_true[b, i, j])
+    return jnp.cat(pairs), jnp.cat(dist)
+
+def lddt_sparse(predicted_points, neighbors, per_residue=False):
+    """lddt evaluated on the pairs of neighbor_list(true_points, cutoff) only.
 
-    # True lDDT uses a number of fixed bins.
-    # We ignore the physical plausibility correction to lDDT, though.
+    Gives the same score as lddt(predicted_points, true_points, cutoff,
+    per_residue) at the cost of the number of pairs within cutoff instead of
+    length^2.
+    """
+    pairs, dmat_true = neighbors
+    batch, length = predicted_points.shape[:2]
+    b, i, j = pairs.unbind(-1)
+    dmat_predicted = jnp.sqrt(1e-10 + jnp.sum(
+            (predicted_points[b, i] - predicted_points[b, j])**2, axis=-1))
+    dist_l1 = jnp.abs(dmat_true - dmat_predicted)
     score = 0.25 * ((dist_l1 < 0.5).float()   +
                                     (dist_l1 < 1.0).float()   +
                                     (dist_l1 < 2.0).float()   +
                                     (dist_l1 < 4.0).float()  )
-    # Normalize over the appropriate axes.
-    reduce_axes = (-1,) if per_residue else (-2, -1)
-    norm = 1. / (1e-10 + jnp.sum(dists_to_score, axis=reduce_axes))
-    score = norm * (1e-10 + jnp.sum(dists_to_score * score, axis=reduce_axes))
-
-    return score
+    sums = jnp.zeros((batch * length, 2), dtype=score.dtype, device=score.device)
+    sums.index_add_(0, b * length + i, jnp.stack([jnp.ones_like(score), score], dim=-1))
+    return normalize(sums.view(batch, length, 2), per_residue)
 if __name__ == '__main__':
 
     predicted_points = jnp.randn(3, 5, 3, requires_grad=True)
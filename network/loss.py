@@ -1,14 +1,29 @@
 import torch
 import lddt_torch
+from lddt_torch import dist_rows, map_rows
 import rigid_transform_3D
+
+def residue_counts(pad_mask, B, L, device):
+    """
+    (B,) real residues of every sample: pad_mask (B, L) is True on them, as
+    collate_batch_data returns it; without pad_mask every sample has L
+    """
+    if pad_mask is None:
+        return torch.full((B,), float(L), device=device)
+    return pad_mask.to(device).sum(-1).float()
+
 class Loss:
-    def __init__(self, device) -> None:
+    def __init__(self, device, chunk=128) -> None:
         self.device = device
-        pass
+        # rows of the L x L distance maps computed at a time, None for all
+        self.chunk = chunk
+        # cutoff of lddt_loss, and of the neighbor lists built for it
+        self.lddt_cutoff = 15
 
     def cross_loss_mask(self, pred_, true_, mask):
         pred_ = pred_.reshape(-1, pred_.shape[-1])
-        true_ = torch.flatten(true_)
+        # labels and mask come as uint8/bool, widened only here
+        true_ = torch.flatten(true_).long()
         mask = torch.flatten(mask).float()
         cross_func = torch.nn.CrossEntropyLoss(reduction='none')
         loss = cross_func(pred_, true_)
@@ -16,50 +31,73 @@ class Loss:
         result = torch.mean(loss)
         return result
 
-    def coords_loss_rotate(self,pred_, true_):
-        def get_r_t(pred_, true_):
-            true_ca = true_.view(-1, 3, 3)[:,1,:]
-            pred_ca = pred_.view(-1, 3, 3)[:,1,:]
-            select_atoms = torch.where(~torch.isnan(true_ca))
-            true_coords = true_ca[select_atoms].view(-1, 3)
-            pred_coords = pred_ca[select_atoms].view(-1, 3)
-            R, t = rigid_transform_3D.rigid_transform_3D2(pred_coords, true_coords)
-            return R, t
-        losses = 0
-        for pred_true, cur_true in zip(pred_, true_):
-            mse_loss = torch.nn.MSELoss()
-            cur_mask = torch.isnan(cur_true)
-            R, t = get_r_t(pred_true, cur_true)
-            pred_true = pred_true.masked_fill(cur_mask, 0)
-            cur_true = cur_true.masked_fill(cur_mask, 0)
-            pred_rotate = torch.matmul(pred_true, R) + t
-            c = mse_loss(pred_rotate, cur_true)
-            c = torch.sqrt(c)
-            losses = losses + c
+    def cross_loss_heads(self, logits_s, labels, mask, pad_mask=None):
+        """
+        cross_loss_mask of every head at once
+        logits_s: (B, C, L, L) logits of the heads, as DistanceNetwork returns them
+        labels: (B, L, L) bins of every head
+        mask: (B, L, L) pairs to score
+        pad_mask: optional (B, L) real residues of a padded batch
+        The masked-in pairs are gathered once and only their logits are scored;
+        every loss is still averaged over all l x l pairs of a sample like
+        cross_loss_mask, and then over the batch.
+        """
+        B, L = mask.shape[:2]
+        b, i, j = torch.nonzero(mask, as_tuple=True)
+        # every pair counts 1 / (B l^2) of its sample's length l
+        n = residue_counts(pad_mask, B, L, mask.device)
+        w = 1 / (B * n * n)[b]
+        losses = []
+        for logits, true_ in zip(logits_s, labels):
+            # (P, C) logits of the masked-in pairs
+            pred_ = logits[b, :, i, j].float()
+            loss = torch.nn.functional.cross_entropy(pred_, true_[b, i, j].long(), reduction='none')
+            losses.append(torch.sum(loss * w))
         return losses
 
-    def dis_mse_whole_atom(self, predicted_points, true_points):
+    def coords_loss_rotate(self,pred_, true_, pad_mask=None):
+        B = pred_.shape[0]
+        # superpose on CA, for the whole batch at once on the device of pred_
+        true_ca = true_.view(B, -1, 3, 3)[:,:,1]
+        pred_ca = pred_.view(B, -1, 3, 3)[:,:,1]
+        R, t = rigid_transform_3D.kabsch(pred_ca, true_ca)
+        mask = torch.isnan(true_)
+        pred_ = pred_.masked_fill(mask, 0)
+        true_ = true_.masked_fill(mask, 0)
+        # rows without a label (missing residues and padding) count 0 after the
+        # superposition too, not the translation t
+        diff = (torch.matmul(pred_, R) + t - true_).masked_fill(mask, 0)
+        # rms over the 3 x 3 l coordinates of every sample, then the mean over
+        # the batch, see MultiBackward
+        n = residue_counts(pad_mask, B, true_ca.shape[1], pred_.device)
+        losses = torch.sqrt(torch.sum(diff**2, dim=(1, 2)) / (9 * n))
+        return torch.mean(losses)
+
+    def dis_mse_whole_atom(self, predicted_points, true_points, pad_mask=None):
         """
         compute whole matrix loss
         """
-        # Compute true and predicted distance matrices.
-        dmat_true = torch.sqrt(1e-10 + torch.sum((true_points[:, :, None] - true_points[:, None, :])**2, axis=-1))
+        B, L = true_points.shape[:2]
+        # atoms of every sample, 3 per residue
+        n = 3 * residue_counts(pad_mask, B, L // 3, true_points.device)
+        def rows(i0, i1, predicted_points, true_points):
+            # Compute rows i0:i1 of the true and predicted distance matrices.
+            dmat_true = dist_rows(true_points, i0, i1)
+            dmat_predicted = dist_rows(predicted_points, i0, i1)
+            mask = (~torch.isnan(dmat_true)).float() * (1 - torch.eye(L, device=dmat_true.device)[i0:i1])
+            mask = mask * (dmat_true < 20).float()
 
-        dmat_predicted = torch.sqrt(1e-10 + torch.sum(
-                (predicted_points[:, :, None] -
-                predicted_points[:, None, :])**2, axis=-1))
-        mask = (~torch.isnan(dmat_true)).float() * (1 - torch.eye(true_points.shape[1]))
-        mask = mask * (dmat_true < 20).float()
-        
-        dmat_true = dmat_true.masked_fill(~mask.bool(), 0)
-        dmat_predicted = dmat_predicted.masked_fill(~mask.bool(), 0)
-        dmat_true = mask * dmat_true
-        mse_loss = torch.nn.MSELoss()
-        loss = mse_loss(dmat_predicted, dmat_true)
+            dmat_true = dmat_true.masked_fill(~mask.bool(), 0)
+            dmat_predicted = dmat_predicted.masked_fill(~mask.bool(), 0)
+            dmat_true = mask * dmat_true
+            return torch.sum((dmat_predicted - dmat_true)**2, axis=-1)
+        # rms over the L x L map of every sample, summed a chunk of rows at a time,
+        # then the mean over the batch
+        loss = torch.sum(map_rows(rows, L, self.chunk, predicted_points, true_points), dim=-1) / (n * n)
         loss = torch.sqrt(loss)
-        return loss
+        return torch.mean(loss)
 
-    def dis_mse_loss_ca(self, predicted_points, true_points):
+    def dis_mse_loss_ca(self, predicted_points, true_points, pad_mask=None):
         """
         is just like lddt
         """
@@ -67,25 +105,30 @@ class Loss:
         # ca
         true_points = true_points.view(B, -1, 3, 3)[:,:,1]
         predicted_points = predicted_points.view(B, -1, 3, 3)[:,:,1]
-        # Compute true and predicted distance matrices.
-        dmat_true = torch.sqrt(1e-10 + torch.sum((true_points[:, :, None] - true_points[:, None, :])**2, axis=-1))
+        L = true_points.shape[1]
+        def rows(i0, i1, predicted_points, true_points):
+            # Compute rows i0:i1 of the true and predicted distance matrices.
+            dmat_true = dist_rows(true_points, i0, i1)
+            dmat_predicted = dist_rows(predicted_points, i0, i1)
 
-        dmat_predicted = torch.sqrt(1e-10 + torch.sum(
-                (predicted_points[:, :, None] -
-                predicted_points[:, None, :])**2, axis=-1))
+            mask = (dmat_true < 15).float() * (1 - torch.eye(L, device=dmat_true.device)[i0:i1])
+            #score = 0.25 * ((tmp < 0.5).float() + (tmp < 1.0).float() + (tmp < 2.0).float() + (tmp < 4.0).float())
 
-        tmp = torch.abs(dmat_true - dmat_predicted)
-        mask = (dmat_true < 15).float() * (1 - torch.eye(true_points.shape[1]))
-        #score = 0.25 * ((tmp < 0.5).float() + (tmp < 1.0).float() + (tmp < 2.0).float() + (tmp < 4.0).float())
-
-        dmat_true = dmat_true.masked_fill(~mask.bool(), 0)
-        mse_loss = torch.nn.MSELoss(reduction='none')
-        loss = mse_loss(dmat_predicted, dmat_true)
-        loss = mask * loss
-        #loss = score * loss
-        loss = torch.sqrt(torch.mean(loss))
-        return loss
-    def lddt_loss(self, pred_, true_, model_lddt):
+            dmat_true = dmat_true.masked_fill(~mask.bool(), 0)
+            loss = (dmat_predicted - dmat_true)**2
+            loss = mask * loss
+            #loss = score * loss
+            return torch.sum(loss, axis=-1)
+        n = residue_counts(pad_mask, B, L, true_points.device)
+        loss = torch.sum(map_rows(rows, L, self.chunk, predicted_points, true_points), dim=-1) / (n * n)
+        loss = torch.sqrt(loss)
+        return torch.mean(loss)
+    def lddt_loss(self, pred_, true_, model_lddt, neighbors=None, pad_mask=None):
+        """
+        neighbors: optional lddt_torch.neighbor_list of the true CA at
+        self.lddt_cutoff, to score only the pairs within the cutoff
+        pad_mask: optional (B, L) real residues of a padded batch
+        """
         batch_size = pred_.shape[0]
         xyz_ca = pred_.view(batch_size, -1, 3, 3)[:,:,1]
         xyz_label_ca = true_.view(batch_size, -1, 3, 3)[:,:,1]
@@ -94,10 +137,60 @@ class Loss:
         # xyz_label_ca = xyz_label_ca.masked_fill(mask, 0)
         # xyz_ca = xyz_ca.masked_fill(mask, 0)
 
-        lddt_result = lddt_torch.lddt(xyz_ca.float(), xyz_label_ca.float(), 15, True)
+        if neighbors is None:
+            lddt_result = lddt_torch.lddt(xyz_ca.float(), xyz_label_ca.float(), self.lddt_cutoff, True, chunk=self.chunk)
+        else:
+            lddt_result = lddt_torch.lddt_sparse(xyz_ca.float(), neighbors, True)
         mse_loss = torch.nn.MSELoss(reduction='none')
         loss = mse_loss(model_lddt, lddt_result)
         loss = (~mask[:,:,0]).float() * loss
-        loss = torch.mean(loss)
+        # mean over the l residues of every sample, then over the batch
+        n = residue_counts(pad_mask, batch_size, loss.shape[1], loss.device)
+        loss = torch.mean(torch.sum(loss, dim=-1) / n)
         return loss
-        
+
+def _peak_memory(fn_name, L, chunk, device, queue):
+    """
+    peak memory (MB) of forward + backward of Loss.fn_name on (1, 3L, 3) points
+    """
+    import resource
+    # warm up first, so that lazily loaded code does not count as loss memory
+    x = torch.randn(1, 12, 3, device=device, requires_grad=True)
+    getattr(Loss(device, chunk=1), fn_name)(x, x.detach() + 1).backward()
+    torch.manual_seed(0)
+    true_ = torch.randn(1, L * 3, 3, device=device) * 10
+    pred_ = (true_ + torch.randn_like(true_)).requires_grad_()
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.max_memory_allocated(device)
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    loss = getattr(Loss(device, chunk=chunk), fn_name)(pred_, true_)
+    loss.backward()
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((peak - base) / 2**20)
+
+def benchmark_memory(lengths=(128, 256, 512, 1024), chunks=(None, 128, 32), fn_names=("dis_mse_whole_atom", "dis_mse_loss_ca")):
+    """
+    peak memory of the distance losses versus L, every run in a fresh process
+    so that CPU peaks (max RSS) do not carry over between runs
+    """
+    import multiprocessing as mp
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    ctx = mp.get_context("spawn")
+    for fn_name in fn_names:
+        for L in lengths:
+            result = []
+            for chunk in chunks:
+                queue = ctx.Queue()
+                p = ctx.Process(target=_peak_memory, args=(fn_name, L, chunk, device, queue))
+                p.start()
+                result.append("chunk %s %.0f MB" % (chunk, queue.get()))
+                p.join()
+            print("%s %s L %d: %s" % (device.type, fn_name, L, ", ".join(result)))
+
+if __name__ == '__main__':
+    benchmark_memory()
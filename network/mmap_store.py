@@ -0,0 +1,75 @@
+'''
+Flat binary container for a few named numpy arrays that can be memory-mapped
+back without copying.
+
+layout: MAGIC | uint64 header size | json header | aligned array blocks
+'''
+import json
+import mmap
+import shutil
+import struct
+from collections import namedtuple
+import numpy as np
+
+MAGIC = b"RFMMAP01"
+ALIGN = 64
+
+# array already dumped with ndarray.tofile, copied into the container as is
+RawArray = namedtuple("RawArray", "filename, dtype, shape")
+
+def _pad(n):
+    return (ALIGN - n % ALIGN) % ALIGN
+
+def write_arrays(filename, arrays, meta=None):
+    '''
+    Write a dict of numpy arrays or RawArray (and a json-able meta dict) to `filename`
+    '''
+    arrays = {k: v if isinstance(v, RawArray) else np.ascontiguousarray(v) for k, v in arrays.items()}
+    layout = {}
+    offset = 0
+    for k, v in arrays.items():
+        dtype, shape = np.dtype(v.dtype), [int(i) for i in v.shape]
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        layout[k] = {"dtype": dtype.str, "shape": shape, "offset": offset, "nbytes": nbytes}
+        offset += nbytes + _pad(nbytes)
+    header = json.dumps({"meta": meta or {}, "arrays": layout}).encode("utf-8")
+    start = len(MAGIC) + 8 + len(header)
+    header += b" " * _pad(start)
+    with open(filename, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<Q", len(header)))
+        fh.write(header)
+        for k, v in arrays.items():
+            nbytes = layout[k]["nbytes"]
+            if isinstance(v, RawArray):
+                with open(v.filename, "rb") as src:
+                    shutil.copyfileobj(src, fh, 1<<24)
+            else:
+                fh.write(v.reshape(-1).view(np.uint8).data)
+            fh.write(bytes(_pad(nbytes)))
+
+def read_header(filename):
+    with open(filename, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a mmap_store file" % filename)
+        size, = struct.unpack("<Q", fh.read(8))
+        header = json.loads(fh.read(size).decode("utf-8"))
+    return header, len(MAGIC) + 8 + size
+
+def map_arrays(filename):
+    '''
+    Map `filename` read-only and return (dict of array views, meta)
+    '''
+    header, start = read_header(filename)
+    with open(filename, "rb") as fh:
+        data = mmap.mmap(fh.fileno(), 0, prot=mmap.PROT_READ)
+    arrays = {}
+    for k, v in header["arrays"].items():
+        dtype = np.dtype(v["dtype"])
+        count = int(np.prod(v["shape"], dtype=np.int64))
+        if count == 0:
+            arrays[k] = np.zeros(v["shape"], dtype=dtype)
+            continue
+        arr = np.frombuffer(data, dtype=dtype, count=count, offset=start + v["offset"])
+        arrays[k] = arr.reshape(v["shape"])
+    return arrays, header["meta"]
@@ -1,3 +1,6 @@
+import contextlib
+from torch.nn.utils import clip_grad_value_
+
 class MultiBackwardBak:
     def __init__(self, optimizer, batch_size):
         self.all_loss = []
@@ -21,23 +24,132 @@ class MultiBackwardBak:
             self.backward()
 
 class MultiBackward:
-    def __init__(self, optimizer, batch_size):
-        self.all_loss = []
+    """
+    Gradient accumulation over micro-batches.
+
+    add_loss backpropagates every micro-batch right away, so only its graph
+    is alive, and steps the optimizer once the accumulated micro-batches
+    reach max_tokens (L^2 x N msa tokens of the padded batches, see
+    batch_tokens), or max_tokens samples when no token count is given.
+    Losses are taken as means over their micro-batch: they are weighted by
+    the micro-batch size and the gradients divided by the number of samples
+    of the step, so a step sees the mean over its effective batch. Gradients
+    are clipped once per step. With a DistributedDataParallel model, all but
+    the last micro-batch of a step run under model.no_sync().
+    """
+    def __init__(self, optimizer, max_tokens, parameters=None, clip_value=None, model=None):
         self.optimizer = optimizer
-        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.parameters = [p for g in optimizer.param_groups for p in g["params"]] if parameters is None else list(parameters)
+        self.clip_value = clip_value
+        self.model = model
+        self.n_steps = 0
+        self.reset()
+        self.optimizer.zero_grad()
+
+    def reset(self):
+        self.tokens = 0
+        self.n_samples = 0
+        self.n_micro = 0
+
+    @staticmethod
+    def batch_tokens(msa):
+        """
+        L^2 x N tokens of a padded (B, N, L) msa batch
+        """
+        B, N, L = msa.shape[:3]
+        return B * N * L * L
+
     def step(self):
+        if self.n_samples == 0:
+            return
+        for p in self.parameters:
+            if p.grad is not None:
+                p.grad.div_(self.n_samples)
+        if self.clip_value is not None:
+            clip_grad_value_(self.parameters, self.clip_value)
         self.optimizer.step()
         self.optimizer.zero_grad()
-        self.all_loss = []
-    def add_loss(self, loss):
-        if len(self.all_loss) == 0:
-            self.optimizer.zero_grad()
-        loss.backward()
-        if len(self.all_loss) == self.batch_size:
-            self.step()
-        self.all_loss.append(loss)
-    def __del__(self):
-        if len(self.all_loss) > 0:
+        self.n_steps += 1
+        self.reset()
+
+    def add_loss(self, loss, n_samples=1, tokens=None):
+        """
+        backward of the mean loss of a micro-batch of n_samples; True if the
+        optimizer stepped
+        """
+        size = n_samples if tokens is None else tokens
+        last = self.tokens + size >= self.max_tokens
+        sync = last or self.model is None or not hasattr(self.model, "no_sync")
+        with contextlib.nullcontext() if sync else self.model.no_sync():
+            (loss * n_samples).backward()
+        self.tokens += size
+        self.n_samples += n_samples
+        self.n_micro += 1
+        if last:
             self.step()
+        return last
+
+    def flush(self):
+        """
+        step on what is left at the end of an epoch (under no_sync these
+        micro-batches were not all-reduced, they only count on this rank)
+        """
+        self.step()
+
+def check_accumulation(batch=4, L=24, splits=((4,), (2, 2), (1, 1, 1, 1)), seed=0):
+    """
+    one optimizer step over `batch` samples, taken as micro-batches of every
+    split, with the training losses (Loss, as train.py sums them) on a small
+    model; the updated parameters must not depend on the split
+    (samples of one length; test_loss.py covers padded batches of several)
+    """
+    import torch
+    import lddt_torch
+    from loss import Loss
+    torch.manual_seed(seed)
+    feat = torch.randn(batch, L, 8, dtype=torch.float64)
+    xyz_label = torch.randn(batch, L * 3, 3, dtype=torch.float64) * 5
+    xyz_label[:, :6] = float("nan")
+    labels = [torch.randint(0, n, (batch, L, L)) for n in (37, 25, 25, 13)]
+    mask = torch.rand(batch, L, L) < 0.7
+    loss = Loss(torch.device("cpu"), chunk=7)
+
+    class Model(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.xyz = torch.nn.Linear(8, 9)
+            self.pair = torch.nn.ModuleList([torch.nn.Linear(8, n) for n in (37, 25, 25, 13)])
+            self.lddt = torch.nn.Linear(8, 1)
+
+        def forward(self, x):
+            xyz = self.xyz(x).view(x.shape[0], -1, 3) * 5
+            logits_s = [(p(x)[:, :, None] + p(x)[:, None]).permute(0, 3, 1, 2) for p in self.pair]
+            return xyz, torch.sigmoid(self.lddt(x))[..., 0], logits_s
 
+    params = []
+    for split in splits:
+        torch.manual_seed(seed + 1)
+        model = Model().double()
+        optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+        multi_back = MultiBackward(optimizer, batch, clip_value=None, model=model)
+        start = 0
+        for n in split:
+            sel = slice(start, start + n)
+            start += n
+            xyz, model_lddt, logits_s = model(feat[sel])
+            neighbors = lddt_torch.neighbor_list(xyz_label[sel].view(n, -1, 3, 3)[:, :, 1], loss.lddt_cutoff)
+            terms = loss.cross_loss_heads(logits_s, [l[sel] for l in labels], mask[sel]) + [
+                loss.coords_loss_rotate(xyz, xyz_label[sel]),
+                loss.dis_mse_whole_atom(xyz, xyz_label[sel]),
+                loss.dis_mse_loss_ca(xyz, xyz_label[sel]),
+                loss.lddt_loss(xyz, xyz_label[sel], model_lddt, neighbors)]
+            multi_back.add_loss(sum(terms), n_samples=n)
+        assert multi_back.n_steps == 1
+        params.append(torch.cat([p.detach().flatten() for p in model.parameters()]))
+    for split, p in zip(splits[1:], params[1:]):
+        assert torch.allclose(p, params[0], rtol=1e-9, atol=1e-9), (split, (p - params[0]).abs().max())
+    print("same step for micro-batches %s" % ", ".join([str(s) for s in splits]))
 
+if __name__ == '__main__':
+    check_accumulation()
@@ -3,10 +3,13 @@ import scipy
 import scipy.spatial
 import string
 import os,re
+import mmap
 import random
 import util
 import torch
 from ffindex import *
+import mmap_store
+from hhsearch_hits import parse_hits
 import get_true_pdb_name
 to1letter = {
     "ALA":'A', "ARG":'R', "ASN":'N', "ASP":'D', "CYS":'C',
@@ -15,45 +18,212 @@ to1letter = {
     "SER":'S', "THR":'T', "TRP":'W', "TYR":'Y', "VAL":'V' }
 
 
-# read A3M and convert letters into
-# integers in the 0..20 range,
-def parse_a3m(filename):
-
-    msa = []
-
-    table = str.maketrans(dict.fromkeys(string.ascii_lowercase))
-
-    # read file line by line
-    for line in open(filename,"r"):
-
-        # skip labels
-        if line[0] == '>':
+# 256-entry table from A3M bytes to tokens:
+# "ARNDCQEGHILKMFPSTWYV-" -> 0..20, other characters are treated as gaps (20),
+# lowercase letters (insertions) -> A3M_INS, whitespace -> A3M_SKIP
+A3M_INS = 21
+A3M_SKIP = 22
+a3m_table = np.full(256, 20, dtype=np.uint8)
+a3m_table[np.frombuffer(b"ARNDCQEGHILKMFPSTWYV-", dtype=np.uint8)] = np.arange(21)
+a3m_table[ord('a'):ord('z')+1] = A3M_INS
+a3m_table[np.frombuffer(b" \t\r\n\v\f", dtype=np.uint8)] = A3M_SKIP
+
+def a3m_seq_lines(buf, max_seqs=None, chunk=1<<24):
+    # [start, end) byte ranges of the first max_seqs sequence lines,
+    # scanning the buffer chunk by chunk so that a shallow read stops early
+    starts, ends = [], []
+    nseq, pos, size = 0, 0, buf.shape[0]
+    while pos < size and (max_seqs is None or nseq < max_seqs):
+        stop = min(pos + chunk, size)
+        e = np.flatnonzero(buf[pos:stop] == ord('\n')) + pos
+        if stop == size and (e.shape[0] == 0 or e[-1] != size - 1):
+            e = np.append(e, size)
+        if e.shape[0] == 0:
+            # a single line longer than the chunk
+            chunk *= 2
             continue
+        b = np.concatenate([[pos], e[:-1] + 1])
+        first = buf[np.minimum(b, size - 1)]
+        # skip labels, comments and empty lines
+        keep = (e > b) & (first != ord('>')) & (first != ord('#')) & (a3m_table[first] != A3M_SKIP)
+        b, e2 = b[keep], e[keep]
+        if max_seqs is not None:
+            b, e2 = b[:max_seqs - nseq], e2[:max_seqs - nseq]
+        starts.append(b)
+        ends.append(e2)
+        nseq += b.shape[0]
+        pos = e[-1] + 1
+    if nseq == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(starts).astype(np.int64), np.concatenate(ends).astype(np.int64)
 
-        # remove right whitespaces
-        line = line.rstrip()
-
-        # remove lowercase letters and append to MSA
-        msa.append(line.translate(table)) 
-        if len(msa) > 100:
-            break
-
-    # convert letters into numbers
-    alphabet = np.array(list("ARNDCQEGHILKMFPSTWYV-"), dtype='|S1').view(np.uint8)
-    msa = np.array([list(s) for s in msa], dtype='|S1').view(np.uint8)
-    for i in range(alphabet.shape[0]):
-        msa[msa == alphabet[i]] = i
-
-    # treat all unknown characters as gaps
-    msa[msa > 20] = 20
+# read A3M and convert letters into
+# integers in the 0..20 range,
+# optionally with the number of insertions (lowercase letters) before every position
+def parse_a3m(filename, max_seqs=101, ins=False, block_rows=4096):
+    # max_seqs=None reads the whole alignment
 
+    with open(filename, "rb") as fh:
+        if fh.seek(0, 2) == 0:
+            buf = np.zeros(0, dtype=np.uint8)
+        else:
+            buf = np.frombuffer(mmap.mmap(fh.fileno(), 0, prot=mmap.PROT_READ), dtype=np.uint8)
+
+    starts, ends = a3m_seq_lines(buf, max_seqs)
+    N = starts.shape[0]
+    if N == 0:
+        msa = np.zeros((0, 0), dtype=np.uint8)
+        return (msa, msa.copy()) if ins else msa
+
+    # length of the alignment from the first (query) sequence
+    codes = a3m_table[buf[starts[0]:ends[0]]]
+    L = int(np.count_nonzero(codes <= 20))
+
+    msa = np.empty((N, L), dtype=np.uint8)
+    ins_cnt = np.zeros((N, L), dtype=np.uint8) if ins else None
+
+    # encode blocks of rows, only bytes of sequence lines are touched
+    for r0 in range(0, N, block_rows):
+        r1 = min(r0 + block_rows, N)
+        base = starts[r0]
+        b, e = starts[r0:r1] - base, ends[r0:r1] - base
+        codes = a3m_table[buf[base:ends[r1-1]]]
+
+        # sequence lines alternate with newlines/labels in the block
+        runs = np.zeros(2 * (r1 - r0), dtype=np.int64)
+        runs[0::2] = e - b
+        runs[1:-1:2] = b[1:] - e[:-1]
+        inseq = np.repeat(np.arange(runs.shape[0]) % 2 == 0, runs)
+
+        match = inseq & (codes <= 20)
+        counts = np.add.reduceat(match.view(np.uint8), b, dtype=np.int64)
+        if np.any(counts != L):
+            bad = r0 + int(np.argmax(counts != L))
+            raise ValueError("%s: sequence %d has %d aligned positions, expected %d" % (filename, bad, counts[bad-r0], L))
+        msa[r0:r1] = codes[match].reshape(r1 - r0, L)
+
+        if ins:
+            lower = np.flatnonzero(inseq & (codes == A3M_INS))
+            if lower.shape[0] > 0:
+                ncol = np.cumsum(match, dtype=np.int32)
+                row = np.searchsorted(b, lower, side='right') - 1
+                col = ncol[lower] - (ncol[b] - match[b])[row]
+                # insertions after the last aligned position are dropped
+                sel = col < L
+                cnt = np.bincount(row[sel] * L + col[sel], minlength=(r1 - r0) * L)
+                ins_cnt[r0:r1] = np.minimum(cnt, 255).reshape(r1 - r0, L)
+
+    if ins:
+        return msa, ins_cnt
     return msa
 
+def msabin_path(base_dir, msa_id):
+    # where data_loader looks for the binary MSA of msa_id, next to its a3m .pt
+    return os.path.join(base_dir, 'torch', 'a3m', msa_id[2:4], msa_id + '.msabin')
+
+# binary MSA cache: flat uint8 tokens and insertion counts of all rows
+# plus a row-offset table, so that filtered/ragged variants fit the same format
+def a3m_to_msabin(a3m_fn, base_dir=None, msa_id=None, out_fn=None, max_seqs=None):
+    # written to msabin_path(base_dir, msa_id) unless out_fn is given,
+    # msa_id defaults to the a3m file name up to the first '.'
+    if out_fn is None:
+        if base_dir is None:
+            raise ValueError("a3m_to_msabin needs base_dir or out_fn")
+        if msa_id is None:
+            msa_id = os.path.basename(a3m_fn).split('.')[0]
+        out_fn = msabin_path(base_dir, msa_id)
+    os.makedirs(os.path.dirname(os.path.abspath(out_fn)), exist_ok=True)
+    msa, ins = parse_a3m(a3m_fn, max_seqs=max_seqs, ins=True)
+    N, L = msa.shape
+    st = os.stat(a3m_fn)
+    mmap_store.write_arrays(out_fn + ".tmp", {"msa": msa.reshape(-1),
+                                             "ins": ins.reshape(-1),
+                                             "offsets": np.arange(N + 1, dtype=np.int64) * L},
+                            {"L": L, "source": os.path.abspath(a3m_fn),
+                             "source_size": st.st_size, "source_mtime_ns": st.st_mtime_ns})
+    os.replace(out_fn + ".tmp", out_fn)
+    return out_fn
+
+def msabin_is_fresh(meta):
+    # False if the a3m the binary was written from has changed since;
+    # a binary whose source is not around any more is taken as is
+    source = meta.get("source")
+    if source is None or not os.path.exists(source):
+        return True
+    st = os.stat(source)
+    return st.st_size == meta.get("source_size") and st.st_mtime_ns == meta.get("source_mtime_ns")
+
+class MSABin:
+    '''
+    Memory-mapped MSA written by a3m_to_msabin.
+    Rows are only read when requested, e.g. by the subsampling in data_loader
+    '''
+    device = torch.device("cpu")
+
+    def __init__(self, filename, cols=None):
+        arrays, self.meta = mmap_store.map_arrays(filename)
+        self.filename = filename
+        self.tokens = arrays["msa"]
+        self.insertions = arrays["ins"]
+        self.offsets = arrays["offsets"]
+        self.L = self.meta["L"]
+        self.cols = cols
+        # rows of one length are read through an (N, L) view
+        self.uniform = bool(np.all(np.diff(self.offsets) == self.L)) and self.offsets[0] == 0
+
+    @property
+    def shape(self):
+        L = self.L if self.cols is None else len(self.cols)
+        return (self.offsets.shape[0] - 1, L)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def select_cols(self, cols):
+        # lazy column selection, applied when rows are read
+        out = MSABin.__new__(MSABin)
+        out.__dict__.update(self.__dict__)
+        cols = np.asarray(cols)
+        out.cols = cols if self.cols is None else self.cols[cols]
+        return out
+
+    def _take(self, data, rows):
+        if rows is None:
+            rows = slice(None)
+        if isinstance(rows, slice):
+            rows = np.arange(self.shape[0])[rows]
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.uniform:
+            out = data[:self.offsets[-1]].reshape(-1, self.L)[rows]
+        else:
+            b, e = self.offsets[rows], self.offsets[rows + 1]
+            if np.any(e - b != self.L):
+                raise ValueError("%s: ragged rows cannot be stacked" % self.filename)
+            out = data[b[:, None] + np.arange(self.L)[None, :]]
+        if self.cols is not None:
+            out = out[:, self.cols]
+        return out
+
+    def rows(self, rows=None):
+        return self._take(self.tokens, rows)
+
+    def ins(self, rows=None):
+        return self._take(self.insertions, rows)
+
+def read_msabin(filename, rows=None, ins=False):
+    msa = MSABin(filename)
+    if ins:
+        return msa.rows(rows), msa.ins(rows)
+    return msa.rows(rows)
+
 # parse HHsearch output
 def parse_hhr(filename, ffindex, idmax=105.0):
 
     # labels present in the database
-    label_set = set([i.name for i in ffindex])
+    if isinstance(ffindex, FFindexDB):
+        label_set = ffindex
+    else:
+        label_set = set([i.name for i in ffindex])
 
     out = []
 
@@ -151,89 +321,106 @@ def parse_pdb(filename):
 
     return xyz,idx
 
+# (residue name, atom name) -> slot in the 14-atom representation,
+# the first matching slot wins as in util.aa2long
+aa_atom2slot = {}
+for i_aa, atoms in enumerate(util.aa2long):
+    for i_atm, atm in enumerate(atoms):
+        if atm is not None and (util.num2aa[i_aa], atm) not in aa_atom2slot:
+            aa_atom2slot[(util.num2aa[i_aa], atm)] = i_atm
+
 def parse_pdb_lines(lines):
 
+    lines = [l for l in lines if l[:4] == "ATOM"]
+    if len(lines) == 0:
+        return np.full((0, 14, 3), 0.0, dtype=np.float32), np.zeros((0, 14), dtype=bool), np.array([])
+
+    # fixed PDB columns of all ATOM records as one (n, 54) byte block
+    block = "".join([l[:54].ljust(54) for l in lines]).encode("ascii", "replace")
+    block = np.frombuffer(block, dtype=np.uint8).reshape(-1, 54)
+    def column(b, e):
+        return np.ascontiguousarray(block[:, b:e]).view("S%d" % (e - b))[:, 0]
+
+    resNo = column(22, 26).astype(np.int64)
+    atom = column(12, 16)
+    coords = np.stack([column(30, 38), column(38, 46), column(46, 54)], axis=-1).astype(np.float64)
+
     # indices of residues observed in the structure
-    idx_s = [int(l[22:26]) for l in lines if l[:4]=="ATOM" and l[12:16].strip()=="CA"]
+    is_ca = np.char.strip(atom) == b"CA"
+    idx_s = resNo[is_ca]
+
+    # residue number -> row of its first CA record
+    uniq, first = np.unique(idx_s, return_index=True)
+    pos = np.minimum(np.searchsorted(uniq, resNo), max(uniq.shape[0] - 1, 0))
+    missing = (uniq.shape[0] == 0) | (uniq[pos] != resNo)
+    if np.any(missing):
+        raise ValueError("%d is not in list" % resNo[np.argmax(missing)])
+    row = first[pos]
+
+    # (residue, atom) -> slot, resolved once per distinct pair
+    keys, inv = np.unique(np.concatenate([block[:, 17:20], block[:, 12:16]], axis=1).copy().view("S7")[:, 0],
+                          return_inverse=True)
+    slot = np.full(keys.shape[0], -1, dtype=np.int64)
+    for i, key in enumerate(keys):
+        key = key.decode("ascii").ljust(7)
+        aa, atm = key[:3], key[3:]
+        util.aa2num[aa] # unknown residues are an error
+        slot[i] = aa_atom2slot.get((aa, atm), -1)
+    slot = slot[inv.reshape(-1)]
 
     # 4 BB + up to 10 SC atoms
-    xyz = np.full((len(idx_s), 14, 3), np.nan, dtype=np.float32)
-    for l in lines:
-        if l[:4] != "ATOM":
-            continue
-        resNo, atom, aa = int(l[22:26]), l[12:16], l[17:20]
-        idx = idx_s.index(resNo)
-        for i_atm, tgtatm in enumerate(util.aa2long[util.aa2num[aa]]):
-            if tgtatm == atom:
-                xyz[idx,i_atm,:] = [float(l[30:38]), float(l[38:46]), float(l[46:54])]
-                break
+    xyz = np.full((idx_s.shape[0], 14, 3), np.nan, dtype=np.float32)
+    sel = np.where(slot >= 0)[0]
+    flat = row[sel] * 14 + slot[sel]
+    # repeated records (altlocs) keep the last one, as the line-by-line loop did
+    _, last = np.unique(flat[::-1], return_index=True)
+    sel = sel[sel.shape[0] - 1 - last]
+    xyz.reshape(-1, 3)[row[sel] * 14 + slot[sel]] = coords[sel]
 
     # save atom mask
     mask = np.logical_not(np.isnan(xyz[...,0]))
     xyz[np.isnan(xyz[...,0])] = 0.0
 
-    return xyz,mask,np.array(idx_s)
-
-def parse_templates(ffdb, hhr_fn, atab_fn, n_templ=10):
+    return xyz,mask,idx_s
 
-    # process tabulated hhsearch output to get
-    # matched positions and positional scores
-    infile = atab_fn 
-    hits = []
-    for l in open(infile, "r").readlines():
-        if l[0]=='>':
-            key = l[1:].split()[0]
-            hits.append([key,[],[]])
-        elif "score" in l or "dssp" in l:
-            continue
-        else:
-            hi = l.split()[:5]+[0.0,0.0,0.0]
-            hits[-1][1].append([int(hi[0]),int(hi[1])])
-            hits[-1][2].append([float(hi[2]),float(hi[3]),float(hi[4])])
+def parse_templates(ffdb, hhr_fn, atab_fn, n_templ=10, tstore=None):
 
-    # get per-hit statistics from an .hhr file
-    # (!!! assume that .hhr and .atab have the same hits !!!)
-    # [Probab, E-value, Score, Aligned_cols, 
+    # matched positions and positional scores from the .atab,
+    # per-hit statistics from the .hhr
+    # [Probab, E-value, Score, Aligned_cols,
     # Identities, Similarity, Sum_probs, Template_Neff]
-    lines = open(hhr_fn, "r").readlines()
-    pos = [i+1 for i,l in enumerate(lines) if l[0]=='>']
-    for i,posi in enumerate(pos):
-        hits[i].append([float(s) for s in re.sub('[=%]',' ',lines[posi]).split()[1::2]])
-        
-    # parse templates from FFDB
-    for i, hi in enumerate(hits):
-        #if hi[0] not in ffids:
-        #    continue
-        # v = hi[0].split("|")[1]
-        # v_res = get_true_pdb_name.get_pdb(v)
-        # if not v_res:
-        #     continue
-
-        entry = get_entry_by_name(hi[0], ffdb.index)
-        if entry == None:
-            continue
-        data = read_entry_lines(entry, ffdb.data)
-        hits[i] += list(parse_pdb_lines(data))
+    hits = parse_hits(hhr_fn, atab_fn)
+    stats = hits.stats_array()
 
     # process hits
     counter = 0
     xyz,qmap,mask,f0d,f1d,ids = [],[],[],[],[],[]
-    for data in hits:
-        if len(data)<7:
-            continue
-        
-        qi,ti = np.array(data[1]).T
+    for i, name in enumerate(hits.names):
+        #if name not in ffids:
+        #    continue
+
+        # parse templates from FFDB,
+        # pre-parsed structures (templ_store.py) if available
+        parsed = tstore.get(name) if tstore is not None else None
+        if parsed is None:
+            entry = get_entry_by_name(name, ffdb.index)
+            if entry == None:
+                continue
+            parsed = parse_pdb_lines(read_entry_lines(entry, ffdb.data))
+        xyz_i, mask_i, idx_i = parsed
+
+        qi, ti, scores = hits.hit(i)
         # 这个函数的使用意义重大
-        _,sel1,sel2 = np.intersect1d(ti, data[6], return_indices=True)
+        _,sel1,sel2 = np.intersect1d(ti, idx_i, return_indices=True)
         ncol = sel1.shape[0]
         if ncol < 10:
             continue
-        
-        ids.append(data[0])
-        f0d.append(data[3])
-        f1d.append(np.array(data[2])[sel1])
-        xyz.append(data[4][sel2])
-        mask.append(data[5][sel2])
+
+        ids.append(name)
+        f0d.append(stats[i])
+        f1d.append(scores[sel1])
+        xyz.append(xyz_i[sel2])
+        mask.append(mask_i[sel2])
         qmap.append(np.stack([qi[sel1]-1,[counter]*ncol],axis=-1))
         counter += 1
     if len(xyz) == 0:
@@ -247,22 +434,19 @@ def parse_templates(ffdb, hhr_fn, atab_fn, n_templ=10):
     return torch.from_numpy(xyz), torch.from_numpy(qmap), \
            torch.from_numpy(f0d), torch.from_numpy(f1d), ids
 
-def read_templates(qlen, ffdb, hhr_fn, atab_fn, n_templ=10):
-    xyz_t, qmap, t0d, t1d, ids = parse_templates(ffdb, hhr_fn, atab_fn)
+def read_templates(qlen, ffdb, hhr_fn, atab_fn, n_templ=10, tstore=None):
+    xyz_t, qmap, t0d, t1d, ids = parse_templates(ffdb, hhr_fn, atab_fn, tstore=tstore)
     if xyz_t is None:
         return None, None, None
     npick = min(n_templ, len(ids))
-    sample = torch.arange(npick)
     #
     xyz = torch.full((npick, qlen, 3, 3), np.nan).float()
     f1d = torch.zeros((npick, qlen, 3)).float()
-    f0d = list()
     # 感觉是直接替换了对应的位置
     # 每个hhr都有匹配的位置，应该是拿这个位置跟他做匹配了
-    for i, nt in enumerate(sample):
-        sel = torch.where(qmap[:,1] == nt)[0]
-        pos = qmap[sel, 0]
-        xyz[i, pos] = xyz_t[sel, :3]
-        f1d[i, pos] = t1d[sel, :3]
-        f0d.append(torch.stack([t0d[nt,0]/100.0, t0d[nt, 4]/100.0, t0d[nt,5]], dim=-1))
-    return xyz, f1d, torch.stack(f0d, dim=0)
+    # the first npick templates are picked, so qmap[:,1] is already the output slot
+    sel = torch.where(qmap[:,1] < npick)[0]
+    xyz[qmap[sel,1], qmap[sel,0]] = xyz_t[sel, :3]
+    f1d[qmap[sel,1], qmap[sel,0]] = t1d[sel, :3]
+    f0d = torch.stack([t0d[:npick,0]/100.0, t0d[:npick,4]/100.0, t0d[:npick,5]], dim=-1)
+    return xyz, f1d, f0d
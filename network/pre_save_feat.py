@@ -1,23 +1,26 @@
+import argparse
 import codecs
+import json
 import os
 import numpy as np
 import get_true_pdb_name
-import pickle
-import torch
+from multiprocessing import Pool
 
 from ffindex import *
-from kinematics import xyz_to_t2d
 from parsers import parse_a3m, read_templates
+from templ_store import open_templ_store
+from templ_cache import TemplCache, read_templates_cached
+from train_store import TrainStoreWriter
 
 def read_xyz(path):
     """
     x y z x y z x y z
     x y z x y z x y z
     """
-    return np.load(path).astype(np.float)
+    return np.load(path).astype(np.float32)
 def read_mask(path):
     data = np.load(path)
-    return data.astype(np.int)
+    return data.astype(bool)
 
 def read_dis_angle(path):
     """
@@ -32,70 +35,171 @@ def read_dis_angle(path):
     omega_distribute = data[..., 1]
     theta_distribute = data[..., 2]
     phi_distribute = data[..., 3]
-    return [dis_distribute.astype(np.int), omega_distribute.astype(np.int), theta_distribute.astype(np.int), phi_distribute.astype(np.int)]
-def read_data_forsave(data_path):
-    FFDB="pdb100_2021Mar03/pdb100_2021Mar03/pdb100_2021Mar03"
-    FFindexDB = namedtuple("FFindexDB", "index, data")
-    ffdb = None
-    ffdb = FFindexDB(read_index(FFDB+'_pdb.ffindex'),
-                     read_data(FFDB+'_pdb.ffdata'))
-    data = []
-    def check_file_ok(seq_feat_path, seq_name):
-        files = ["t000_.msa0.a3m", "t000_.hhr", "t000_.atab", seq_name + ".xyz.npy", seq_name + ".dis_angle.npy", seq_name + ".mask.npy"]
-        return all([os.path.exists(os.path.join(seq_feat_path, i)) for i in files])
+    return [dis_distribute.astype(np.uint8), omega_distribute.astype(np.uint8), theta_distribute.astype(np.uint8), phi_distribute.astype(np.uint8)]
+FFDB="pdb100_2021Mar03/pdb100_2021Mar03/pdb100_2021Mar03"
+MANIFEST = "manifest.json"
+# per-process template sources, set up by init_featurizer
+_ffdb, _tstore, _templ_cache = None, None, None
+
+# label files of every label layout of the store
+LABEL_FILES = {
+    "bins": [".dis_angle.npy", ".mask.npy"],
+    "ncaccb": [".ncaccb.npy"],
+}
+
+def input_files(seq_feat_path, seq_name, labels="bins"):
+    files = ["t000_.msa0.a3m", "t000_.hhr", "t000_.atab", seq_name + ".xyz.npy"] + [seq_name + i for i in LABEL_FILES[labels]]
+    return [os.path.join(seq_feat_path, i) for i in files]
+
+def check_file_ok(seq_feat_path, seq_name, labels="bins"):
+    return all([os.path.exists(i) for i in input_files(seq_feat_path, seq_name, labels)])
+
+def input_stamp(seq_feat_path, seq_name, use_hash=False, labels="bins"):
+    """
+    what a target was built from: size and mtime, or content hash, of every input file
+    """
+    stamp = []
+    for fn in input_files(seq_feat_path, seq_name, labels):
+        if use_hash:
+            stamp.append([os.path.basename(fn), file_checksum(fn)])
+        else:
+            st = os.stat(fn)
+            stamp.append([os.path.basename(fn), st.st_size, st.st_mtime_ns])
+    return stamp
+
+def read_train_list(data_path):
+    targets = []
     for line in codecs.open(data_path):
-        # if len(data) >= 10:
-        #     break
-        line = line.strip().split(",")
-        seq_name,seq_feat_path = line
-        if not check_file_ok(seq_feat_path, seq_name):
+        line = line.strip()
+        if not line:
+            continue
+        seq_name, seq_feat_path = line.split(",")
+        targets.append((seq_name, seq_feat_path))
+    return targets
+
+def init_featurizer():
+    global _ffdb, _tstore, _templ_cache
+    _ffdb = FFindexDB.open(FFDB+'_pdb.ffindex', FFDB+'_pdb.ffdata')
+    _tstore = open_templ_store(FFDB)
+    _templ_cache = TemplCache("./generate_feat/templ_cache")
+
+def featurize_target(seq_name, seq_feat_path, labels="bins"):
+    """
+    all stored fields of one target, None if it has no templates
+    """
+    msa = parse_a3m(os.path.join(seq_feat_path, "t000_.msa0.a3m"))
+    N, L = msa.shape
+    # if L > 100:
+    #     return None
+    xyz_t, t1d, t0d = read_templates_cached(_templ_cache, L, _ffdb, os.path.join(seq_feat_path, "t000_.hhr"), \
+        os.path.join(seq_feat_path, "t000_.atab"), n_templ=10, tstore=_tstore)
+    if xyz_t is None:
+        return None
+    # print(seq_name,seq_feat_path)
+    xyz_label = read_xyz(os.path.join(seq_feat_path, seq_name + ".xyz.npy"))
+    print(f"debug {seq_name} msa {msa.shape} xyz_t {xyz_t.shape} \
+        xyz_label {xyz_label.shape}")
+    sample = {"msa": msa, "xyz_t": xyz_t.numpy(), "t1d": t1d.numpy(), "t0d": t0d.numpy(), "xyz": xyz_label}
+    if labels == "ncaccb":
+        # binned in the data loader, for the cropped residues only
+        sample["ncaccb"] = read_xyz(os.path.join(seq_feat_path, seq_name + ".ncaccb.npy")).reshape(-1, 4, 3)
+        return sample
+    dis, omega, theta, phi = read_dis_angle(os.path.join(seq_feat_path, seq_name + ".dis_angle.npy"))
+    dis_masks = read_mask(os.path.join(seq_feat_path, seq_name + ".mask.npy"))
+    sample.update({"dis": dis, "omega": omega, "theta": theta, "phi": phi, "mask": dis_masks})
+    return sample
+
+def _featurize_task(args):
+    seq_name, seq_feat_path, stamp, labels = args
+    try:
+        return seq_name, stamp, featurize_target(seq_name, seq_feat_path, labels), None
+    except Exception as e:
+        return seq_name, stamp, None, "%s: %s" % (type(e).__name__, e)
+
+def read_manifest(store_dir):
+    path = os.path.join(store_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+def write_manifest(store_dir, manifest):
+    path = os.path.join(store_dir, MANIFEST)
+    with open(path + ".tmp", "w") as fh:
+        json.dump(manifest, fh)
+    os.replace(path + ".tmp", path)
+
+def build_train_store(data_path, store_dir, n_cpu=1, use_hash=False, shard_bytes=16<<20, labels="bins", flush_secs=60):
+    """
+    Featurize every target of `data_path` into the store at `store_dir`.
+
+    Targets are featurized in a pool of n_cpu processes and added to the
+    store as they finish; a shard (and the index) is written every
+    shard_bytes or flush_secs, and the manifest with it, so a killed run
+    loses at most that much work. A target is skipped when the store (or,
+    for targets without templates, the manifest) already has it with the
+    same input stamp, so an interrupted or repeated run only redoes new,
+    changed and failed targets.
+
+    labels="ncaccb" stores the N,Ca,C,Cb coordinates instead of the binned
+    L x L label maps, which the store then computes per crop when read.
+    """
+    writer = TrainStoreWriter(store_dir, shard_bytes=shard_bytes, append=True, labels=labels, flush_secs=flush_secs)
+    manifest = read_manifest(store_dir)
+    tasks = []
+    for seq_name, seq_feat_path in read_train_list(data_path):
+        if not check_file_ok(seq_feat_path, seq_name, labels):
             continue
-        msa = parse_a3m(os.path.join(seq_feat_path, "t000_.msa0.a3m"))
-        N, L = msa.shape
-        # if L > 100:
-        #     continue
-        xyz_t, t1d, t0d = read_templates(L, ffdb, os.path.join(seq_feat_path, "t000_.hhr"), \
-            os.path.join(seq_feat_path, "t000_.atab"), n_templ=10)
-        if xyz_t is None:
+        stamp = input_stamp(seq_feat_path, seq_name, use_hash=use_hash, labels=labels)
+        if seq_name in writer and writer.meta(seq_name) == stamp:
             continue
-        t2d = xyz_to_t2d(xyz_t, t0d)
-        # print(seq_name,seq_feat_path)
-        xyz_label = read_xyz(os.path.join(seq_feat_path, seq_name + ".xyz.npy"))
-        prob_s_label_2 = read_dis_angle(os.path.join(seq_feat_path, seq_name + ".dis_angle.npy"))
-        dis_masks = read_mask(os.path.join(seq_feat_path, seq_name + ".mask.npy"))
-        label = []
-        label.append(torch.from_numpy(xyz_label).float())
-        label.extend([torch.from_numpy(i) for i in prob_s_label_2])
-
-        masks = torch.from_numpy(dis_masks).long()
-        feat = torch.from_numpy(msa).long(), xyz_t, t1d, t0d, t2d
-
-        print(f"debug {seq_name} msa {torch.from_numpy(msa).shape} xyz_t {xyz_t.shape} \
-            xyz_label {torch.from_numpy(xyz_label).shape}")
-        data.append((feat, label, masks))
-
-    del(ffdb)
-    get_true_pdb_name.clear()
-    print("data reader over")
-    return data
-def save_train2pickle():
-    data = read_data_forsave("./generate_feat/train-feat.list")
-    data_new = []
-    for feat, label, masks in data:
-        feat_new = []
-        label_new = []
-        masks_new = []
-        for j, f in enumerate(feat):
-            feat_new.append(f.tolist())
-        
-        for j, l in enumerate(label):
-            label_new.append(l.tolist())
-
-        for j, l in enumerate(masks):
-            masks_new.append(l.tolist())
-        data_new.append((feat_new, label_new, masks_new))
-    with open("./generate_feat/train_data.pickle", "wb") as f:
-        pickle.dump(data_new, f)
+        # failed targets are retried on every run
+        if manifest.get(seq_name, {}).get("stamp") == stamp and manifest[seq_name].get("status") != "error":
+            continue
+        tasks.append((seq_name, seq_feat_path, stamp, labels))
+    print("build %d targets, %d up to date" % (len(tasks), len(writer.samples)))
+
+    pool = Pool(n_cpu, initializer=init_featurizer) if n_cpu > 1 else None
+    if pool is None:
+        init_featurizer()
+    results = pool.imap_unordered(_featurize_task, tasks) if pool else map(_featurize_task, tasks)
+    n_ok, n_skip, n_err = 0, 0, 0
+    try:
+        for seq_name, stamp, sample, err in results:
+            manifest.pop(seq_name, None)
+            if sample is not None:
+                if writer.add(seq_name, sample, meta=stamp):
+                    write_manifest(store_dir, manifest)
+                n_ok += 1
+                continue
+            # drop a stale sample whose inputs no longer give one
+            writer.remove(seq_name)
+            if err is None:
+                manifest[seq_name] = {"stamp": stamp, "status": "no_templates"}
+                n_skip += 1
+            else:
+                print("error", seq_name, err)
+                manifest[seq_name] = {"stamp": stamp, "status": "error", "error": err}
+                n_err += 1
+            write_manifest(store_dir, manifest)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        writer.close()
+        write_manifest(store_dir, manifest)
+        get_true_pdb_name.clear()
+    print("data reader over: %d built, %d without templates, %d failed" % (n_ok, n_skip, n_err))
 
 if __name__ == '__main__':
-    save_train2pickle()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", dest="data_path", default="./generate_feat/train-feat.list",
+                        help="list of seq_name,feature_dir")
+    parser.add_argument("-o", dest="store_dir", default="./generate_feat/train_store")
+    parser.add_argument("-n", dest="n_cpu", type=int, default=1)
+    parser.add_argument("--hash", dest="use_hash", action="store_true",
+                        help="detect changed inputs by content hash instead of size and mtime")
+    parser.add_argument("--labels", default="bins", choices=["bins", "ncaccb"],
+                        help="store binned label maps, or ncaccb coordinates to bin on the fly")
+    args = parser.parse_args()
+    build_train_store(args.data_path, args.store_dir, n_cpu=args.n_cpu, use_hash=args.use_hash, labels=args.labels)
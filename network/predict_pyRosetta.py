@@ -5,6 +5,8 @@ import torch
 import torch.nn as nn
 from torch.utils import data
 from parsers import parse_a3m, read_templates
+from templ_store import open_templ_store
+from templ_cache import TemplCache, read_templates_cached
 from RoseTTAFoldModel  import RoseTTAFoldModule
 import util
 from collections import namedtuple
@@ -83,7 +85,7 @@ class Predictor():
         N, L = msa.shape
         #
         if hhr_fn != None:
-            xyz_t, t1d, t0d = read_templates(L, ffdb, hhr_fn, atab_fn, n_templ=25)
+            xyz_t, t1d, t0d = read_templates_cached(templ_cache, L, ffdb, hhr_fn, atab_fn, n_templ=25, tstore=tstore)
         else:
             xyz_t = torch.full((1, L, 3, 3), np.nan).float()
             t1d = torch.zeros((1, L, 3)).float()
@@ -183,6 +185,8 @@ def get_args():
                         help="HHsearch output file (atab file)")
     parser.add_argument("--db", default="%s/pdb100_2021Mar03/pdb100_2021Mar03"%script_dir,
                         help="Path to template database [%s/pdb100_2021Mar03]"%script_dir)
+    parser.add_argument("--templ_cache", default="%s/templ_cache"%script_dir,
+                        help="Directory caching template features, empty to disable [%s/templ_cache]"%script_dir)
     parser.add_argument("--cpu", dest='use_cpu', default=False, action='store_true')
 
     args = parser.parse_args()
@@ -191,9 +195,9 @@ def get_args():
 if __name__ == "__main__":
     args = get_args()
     FFDB=args.db
-    FFindexDB = namedtuple("FFindexDB", "index, data")
-    ffdb = FFindexDB(read_index(FFDB+'_pdb.ffindex'),
-                     read_data(FFDB+'_pdb.ffdata'))
+    ffdb = FFindexDB.open(FFDB+'_pdb.ffindex', FFDB+'_pdb.ffdata')
+    tstore = open_templ_store(FFDB)
+    templ_cache = TemplCache(args.templ_cache) if args.templ_cache else None
 
     if not os.path.exists("%s.npz"%args.out_prefix):
         pred = Predictor(model_dir=args.model_dir, use_cpu=args.use_cpu)
@@ -0,0 +1,112 @@
+'''
+Background prefetching over a DataLoader.
+
+A thread pulls batches from the loader and moves them to the device while
+the model computes on the previous batch. On CUDA the copy is issued on a
+side stream and the consumer waits on an event before using the batch; on
+CPU the thread still overlaps loading and collation with compute.
+'''
+import queue
+import threading
+import time
+import torch
+
+def to_device(obj, device, non_blocking=False):
+    if torch.is_tensor(obj):
+        return obj.to(device, non_blocking=non_blocking)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(o, device, non_blocking) for o in obj)
+    return obj
+
+def record_stream(obj, stream):
+    if torch.is_tensor(obj):
+        if obj.is_cuda:
+            obj.record_stream(stream)
+    elif isinstance(obj, (list, tuple)):
+        for o in obj:
+            record_stream(o, stream)
+
+class PrefetchLoader:
+    '''
+    Iterate `loader` with up to `depth` batches loaded ahead, already on `device`.
+
+    wait_time is the time the consumer spent blocked on data and compute_time
+    the time between handing out a batch and asking for the next one.
+    '''
+    _END = object()
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.use_stream = self.device.type == "cuda"
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.wait_time = 0.0
+        self.compute_time = 0.0
+        self.n_batches = 0
+
+    def stats(self):
+        total = self.wait_time + self.compute_time
+        return {"batches": self.n_batches, "wait": self.wait_time, "compute": self.compute_time,
+                "wait_frac": self.wait_time / total if total > 0 else 0.0}
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _produce(self, q, stop):
+        stream = torch.cuda.Stream(self.device) if self.use_stream else None
+        try:
+            for batch in self.loader:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = to_device(batch, self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch, event = to_device(batch, self.device), None
+                while not stop.is_set():
+                    try:
+                        q.put((batch, event, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            q.put((self._END, None, None))
+        except Exception as e:
+            q.put((self._END, None, e))
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                t = time.time()
+                batch, event, err = q.get()
+                self.wait_time += time.time() - t
+                if batch is self._END:
+                    if err is not None:
+                        raise err
+                    return
+                if event is not None:
+                    cur = torch.cuda.current_stream(self.device)
+                    cur.wait_event(event)
+                    # keep the side-stream allocations alive until compute is done with them
+                    record_stream(batch, cur)
+                self.n_batches += 1
+                t = time.time()
+                yield batch
+                self.compute_time += time.time() - t
+        finally:
+            stop.set()
+            # unblock the producer if it is waiting for room in the queue
+            while thread.is_alive():
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
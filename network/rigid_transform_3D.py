@@ -60,11 +60,90 @@ def rigid_transform_3D(A, B):
 
     return R, t
 
+def kabsch(A, B, weights=None):
+    """
+    batched rigid_transform_3D2 in torch, on the device of A and B
+    A, B: (batch, N, 3) points, rows with a NaN in A or B are left out
+    weights: optional (batch, N) weights of the points
+    returns R (batch, 3, 3) and t (batch, 1, 3) with A @ R + t ~ B
+    """
+    A = A.detach()
+    B = B.detach()
+    w = (~(torch.isnan(A).any(-1) | torch.isnan(B).any(-1))).to(A.dtype)
+    if weights is not None:
+        w = w * weights.to(A.dtype)
+    A = torch.nan_to_num(A)
+    B = torch.nan_to_num(B)
+    n = w.sum(-1).clamp(min=1e-8)[:, None, None]
+    centroid_A = (A * w[..., None]).sum(1, keepdim=True) / n
+    centroid_B = (B * w[..., None]).sum(1, keepdim=True) / n
+    Am = A - centroid_A
+    Bm = B - centroid_B
+    # weight one side only: H = sum_i w_i a_i b_i^T
+    H = (Am * w[..., None]).transpose(1, 2) @ Bm
+    U, S, Vt = torch.linalg.svd(H)
+    # special reflection case, flip the last singular vector
+    d = torch.sign(torch.det(U @ Vt))
+    d = torch.where(d == 0, torch.ones_like(d), d)
+    Vt = torch.cat([Vt[:, :2], Vt[:, 2:] * d[:, None, None]], dim=1)
+    R = U @ Vt
+    t = centroid_B - centroid_A @ R
+    return R, t
+
+def check_weights(batch=4, L=50):
+    """
+    kabsch with fractional weights k/4 against rigid_transform_3D2 on the
+    points repeated k times, which is the same fit
+    """
+    A = torch.randn(batch, L, 3, dtype=torch.float64) * 10
+    B = torch.randn(batch, L, 3, dtype=torch.float64) * 10
+    B[:, :L // 10] = float("nan")
+    k = torch.randint(0, 4, (batch, L))
+    R, t = kabsch(A, B, weights=k / 4)
+    for i in range(batch):
+        sel = ~torch.isnan(B[i]).any(-1)
+        rep = torch.repeat_interleave(torch.arange(L)[sel], k[i][sel])
+        R0, t0 = rigid_transform_3D2(A[i][rep], B[i][rep])
+        assert torch.allclose(R[i], R0, atol=1e-8) and torch.allclose(t[i], t0, atol=1e-6)
+
+def benchmark(batch_sizes=(1, 4, 16), lengths=(64, 256, 1024), device=None, n_iter=20):
+    """
+    time the per-sample numpy path against kabsch, and check they agree
+    """
+    import time
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    check_weights()
+    def sync():
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+    for L in lengths:
+        for batch in batch_sizes:
+            A = torch.randn(batch, L, 3, device=device) * 10
+            B = torch.randn(batch, L, 3, device=device) * 10
+            B[:, :L // 10] = float("nan")
+            R, t = kabsch(A, B)
+            for i in range(batch):
+                sel = ~torch.isnan(B[i]).any(-1)
+                R0, t0 = rigid_transform_3D2(A[i][sel].cpu(), B[i][sel].cpu())
+                assert torch.allclose(R[i].cpu(), R0, atol=1e-4) and torch.allclose(t[i].cpu(), t0, atol=1e-3)
+            result = []
+            for fn in [lambda: [rigid_transform_3D2(A[i][~torch.isnan(B[i]).any(-1)].cpu(), B[i][~torch.isnan(B[i]).any(-1)].cpu()) for i in range(batch)],
+                       lambda: kabsch(A, B)]:
+                fn()
+                sync()
+                st = time.time()
+                for _ in range(n_iter):
+                    fn()
+                sync()
+                result.append((time.time() - st) / n_iter * 1000)
+            print("%s L %5d batch %3d: numpy %.3f ms, kabsch %.3f ms" % (device.type, L, batch, result[0], result[1]))
+
 if __name__ == '__main__':
     pointa = torch.randn(1, 100, 3)
     pointb = torch.randn(1, 100, 3)
     mse_loss = torch.nn.MSELoss()
     print(mse_loss(pointa, pointb))
-    R, t = rigid_transform_3D2(pointa, pointb)
+    R, t = kabsch(pointa, pointb)
     c = torch.matmul(pointa, R) + t
-    print(mse_loss(c, pointb))
\ No newline at end of file
+    print(mse_loss(c, pointb))
+    benchmark()
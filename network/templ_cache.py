@@ -0,0 +1,93 @@
+'''
+On-disk cache of template features (xyz_t, t1d, t0d) from read_templates.
+
+Entries are keyed by the content of the .hhr/.atab, the identity of the FFDB,
+the query length and n_templ, stored as compressed .npz files and evicted
+least-recently-used once the directory grows past max_bytes.
+'''
+import hashlib
+import os
+import numpy as np
+import torch
+from equivariant_attention.from_se3cnn.cache_file import FileSystemMutex
+from parsers import read_templates
+
+class TemplCache:
+    def __init__(self, dirname, max_bytes=4<<30):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        os.makedirs(dirname, exist_ok=True)
+        self.mutexfile = os.path.join(dirname, "mutex")
+
+    def key(self, qlen, ffdb, hhr_fn, atab_fn, n_templ):
+        h = hashlib.sha1()
+        for fn in [hhr_fn, atab_fn]:
+            with open(fn, "rb") as fh:
+                h.update(fh.read())
+            h.update(b"\0")
+        h.update(ffdb_identity(ffdb).encode("utf-8"))
+        h.update(("%d %d" % (qlen, n_templ)).encode("utf-8"))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dirname, key + ".npz")
+
+    def get(self, key):
+        path = self.path(key)
+        with FileSystemMutex(self.mutexfile):
+            if not os.path.exists(path):
+                return None
+            # bump the entry for LRU eviction
+            os.utime(path)
+            with np.load(path) as f:
+                if len(f.files) == 0:
+                    return None, None, None
+                return tuple(torch.from_numpy(f[k]) for k in ["xyz_t", "t1d", "t0d"])
+
+    def put(self, key, value):
+        xyz_t, t1d, t0d = value
+        path = self.path(key)
+        tmp = path + ".tmp%d.npz" % os.getpid()
+        if xyz_t is None:
+            np.savez_compressed(tmp)
+        else:
+            np.savez_compressed(tmp, xyz_t=xyz_t.numpy(), t1d=t1d.numpy(), t0d=t0d.numpy())
+        with FileSystemMutex(self.mutexfile):
+            os.replace(tmp, path)
+            self.evict()
+
+    def evict(self):
+        # caller holds the mutex
+        entries = []
+        for e in os.scandir(self.dirname):
+            if e.name.endswith(".npz") and ".tmp" not in e.name:
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum([e[1] for e in entries])
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+def ffdb_identity(ffdb):
+    if ffdb is None:
+        return "none"
+    stamp = []
+    for fn in [ffdb.ffindex_filename, ffdb.ffdata_filename]:
+        st = os.stat(fn)
+        stamp.append("%s:%d:%d" % (os.path.realpath(fn), st.st_size, st.st_mtime_ns))
+    return "|".join(stamp)
+
+def read_templates_cached(cache, qlen, ffdb, hhr_fn, atab_fn, n_templ=10, tstore=None):
+    '''
+    read_templates through `cache` (a TemplCache, or None to always recompute)
+    '''
+    if cache is None:
+        return read_templates(qlen, ffdb, hhr_fn, atab_fn, n_templ=n_templ, tstore=tstore)
+    key = cache.key(qlen, ffdb, hhr_fn, atab_fn, n_templ)
+    value = cache.get(key)
+    if value is None:
+        value = read_templates(qlen, ffdb, hhr_fn, atab_fn, n_templ=n_templ, tstore=tstore)
+        cache.put(key, value)
+    return value
@@ -0,0 +1,130 @@
+'''
+Pre-parsed template structures of a pdb100 FFDB.
+
+Every entry of the _pdb.ffdata is parsed once with parse_pdb_lines and stored
+column-wise in one mmap_store file:
+  names (E,)      sorted entry names, same keys as the ffindex
+  start (E+1,)    first residue row of every entry
+  xyz   (R,14,3)  float32 coordinates
+  mask  (R,14)    atom mask
+  idx   (R,)      residue numbers
+so that parse_templates can take template coordinates as views instead of
+re-parsing the PDB text of every hit.
+
+build: python templ_store.py pdb100_2021Mar03/pdb100_2021Mar03 [n_cpu]
+'''
+import os
+import sys
+import tempfile
+import numpy as np
+from multiprocessing import Pool
+import mmap_store
+from ffindex import FFindexDB, read_entry_lines, search_sorted_names
+from parsers import parse_pdb_lines
+
+def store_filename(ffdb_prefix):
+    return ffdb_prefix + "_pdb.tstore"
+
+def _ffdata_stamp(ffdata_filename):
+    st = os.stat(ffdata_filename)
+    return [st.st_size, st.st_mtime_ns]
+
+def _parse_chunk(args):
+    ffindex_filename, ffdata_filename, begin, end = args
+    ffdb = FFindexDB.open(ffindex_filename, ffdata_filename)
+    out = []
+    for i in range(begin, end):
+        try:
+            xyz, mask, idx = parse_pdb_lines(read_entry_lines(ffdb.entry(i), ffdb.data))
+        except Exception as e:
+            print("skip", ffdb.names[i].decode("utf-8"), e)
+            xyz, mask, idx = None, None, None
+        out.append((xyz, mask, idx))
+    return out
+
+def build_templ_store(ffindex_filename, ffdata_filename, out_filename, n_cpu=1, chunk=1000):
+    ffdb = FFindexDB.open(ffindex_filename, ffdata_filename)
+    E = len(ffdb)
+    tasks = [(ffindex_filename, ffdata_filename, i, min(i + chunk, E)) for i in range(0, E, chunk)]
+
+    start = np.zeros(E + 1, dtype=np.int64)
+    ok = np.zeros(E, dtype=bool)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_filename)))
+    tmp = {k: os.path.join(tmp_dir, k) for k in ["xyz", "mask", "idx"]}
+    fh = {k: open(v, "wb") for k, v in tmp.items()}
+    pool = Pool(n_cpu) if n_cpu > 1 else None
+    results = pool.imap(_parse_chunk, tasks) if pool else map(_parse_chunk, tasks)
+    i, nres = 0, 0
+    # columns are streamed to temporary files so that memory stays flat
+    for parsed in results:
+        for xyz, mask, idx in parsed:
+            if xyz is not None:
+                xyz.astype(np.float32).tofile(fh["xyz"])
+                mask.astype(bool).tofile(fh["mask"])
+                idx.astype(np.int32).tofile(fh["idx"])
+                nres += xyz.shape[0]
+                ok[i] = True
+            i += 1
+            start[i] = nres
+        print("parsed %d/%d" % (i, E))
+    if pool:
+        pool.close()
+        pool.join()
+    for f in fh.values():
+        f.close()
+
+    arrays = {"names": ffdb.names, "start": start, "ok": ok,
+              "xyz": mmap_store.RawArray(tmp["xyz"], np.float32, (nres, 14, 3)),
+              "mask": mmap_store.RawArray(tmp["mask"], bool, (nres, 14)),
+              "idx": mmap_store.RawArray(tmp["idx"], np.int32, (nres,))}
+    meta = {"ffdata": _ffdata_stamp(ffdata_filename)}
+    mmap_store.write_arrays(out_filename + ".tmp", arrays, meta)
+    os.replace(out_filename + ".tmp", out_filename)
+    for v in tmp.values():
+        os.remove(v)
+    os.rmdir(tmp_dir)
+    return out_filename
+
+class TemplStore:
+    def __init__(self, filename):
+        arrays, self.meta = mmap_store.map_arrays(filename)
+        self.filename = filename
+        self.names = arrays["names"]
+        self.start = arrays["start"]
+        self.ok = arrays["ok"]
+        self.xyz = arrays["xyz"]
+        self.mask = arrays["mask"]
+        self.idx = arrays["idx"]
+
+    def __len__(self):
+        return self.names.shape[0]
+
+    def get(self, name):
+        '''
+        Return (xyz, mask, idx) views of a template, None if it is not in the store
+        '''
+        i = int(search_sorted_names(self.names, [name])[0])
+        if i < 0 or not self.ok[i]:
+            return None
+        b, e = self.start[i], self.start[i+1]
+        return self.xyz[b:e], self.mask[b:e], self.idx[b:e]
+
+def open_templ_store(ffdb_prefix, ffdata_filename=None):
+    '''
+    Open the store next to an FFDB if there is an up-to-date one, else None
+    '''
+    filename = store_filename(ffdb_prefix)
+    if not os.path.exists(filename):
+        return None
+    tstore = TemplStore(filename)
+    if ffdata_filename is None:
+        ffdata_filename = ffdb_prefix + "_pdb.ffdata"
+    if tstore.meta.get("ffdata") != _ffdata_stamp(ffdata_filename):
+        print("WARNING: %s does not match %s, parsing templates from text" % (filename, ffdata_filename))
+        return None
+    return tstore
+
+if __name__ == '__main__':
+    FFDB = sys.argv[1]
+    n_cpu = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    print("build", build_templ_store(FFDB+'_pdb.ffindex', FFDB+'_pdb.ffdata', store_filename(FFDB), n_cpu=n_cpu))
@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+from data_reader import collate_batch_data
+from loss import Loss
+"""
+Loss terms of a padded batch against the same samples run one at a time.
+
+  python -m pytest test_loss.py
+"""
+NBINS = (37, 37, 37, 19)
+
+def make_sample(L, rng):
+    xyz = rng.randn(L * 3, 3) * 5
+    xyz[:3] = np.nan
+    feat = (rng.randint(0, 21, (4, L)), rng.randn(2, L, 3, 3), rng.rand(2, L, 3), rng.rand(2, 3))
+    label = (xyz,) + tuple([rng.randint(0, n, (L, L)).astype(np.uint8) for n in NBINS])
+    return feat, label, rng.rand(L, L) < 0.7
+
+def make_prediction(L, rng):
+    xyz = torch.tensor(rng.randn(L * 3, 3) * 5)
+    lddt = torch.tensor(rng.rand(L))
+    logits_s = [torch.tensor(rng.randn(n, L, L)) for n in NBINS]
+    return xyz, lddt, logits_s
+
+def pad(t, L, dims):
+    for d in dims:
+        shape = list(t.shape)
+        shape[d] = L - t.shape[d]
+        t = torch.cat([t, t.new_zeros(shape)], dim=d)
+    return t
+
+def loss_terms(loss, preds, batch):
+    (_, label, masks, _, pad_mask, neighbors) = batch
+    L = pad_mask.shape[1]
+    xyz = torch.stack([pad(p[0], 3 * L, [0]) for p in preds])
+    model_lddt = torch.stack([pad(p[1], L, [0]) for p in preds])
+    logits_s = [torch.stack([pad(p[2][k], L, [1, 2]) for p in preds]) for k in range(len(NBINS))]
+    xyz_label = label[0].double()
+    return loss.cross_loss_heads(logits_s, label[1:], masks, pad_mask) + [
+        loss.coords_loss_rotate(xyz, xyz_label, pad_mask),
+        loss.dis_mse_whole_atom(xyz, xyz_label, pad_mask),
+        loss.dis_mse_loss_ca(xyz, xyz_label, pad_mask),
+        loss.lddt_loss(xyz, xyz_label, model_lddt, neighbors, pad_mask),
+        loss.lddt_loss(xyz, xyz_label, model_lddt, None, pad_mask)]
+
+def test_padded_batch_matches_single_samples():
+    rng = np.random.RandomState(0)
+    lengths = [12, 20]
+    samples = [make_sample(L, rng) for L in lengths]
+    preds = [make_prediction(L, rng) for L in lengths]
+    loss = Loss(torch.device("cpu"), chunk=7)
+    batched = loss_terms(loss, preds, collate_batch_data(samples, lddt_cutoff=loss.lddt_cutoff))
+    single = [loss_terms(loss, [p], collate_batch_data([s], lddt_cutoff=loss.lddt_cutoff)) for s, p in zip(samples, preds)]
+    for k, value in enumerate(batched):
+        expected = (single[0][k] + single[1][k]) / 2
+        assert torch.allclose(value, expected, rtol=1e-6, atol=1e-8), (k, value, expected)
@@ -6,6 +6,7 @@ from torch.nn.modules.loss import MSELoss
 from torch.utils import data
 from RoseTTAFoldModel  import RoseTTAFoldModule_e2e
 from collections import namedtuple
+from functools import partial
 from ffindex import *
 from kinematics import xyz_to_t2d
 from trFold import TRFold
@@ -13,8 +14,8 @@ import torch.optim as optim
 from torch.optim import lr_scheduler
 import data_reader
 import lddt_torch
-from torch.nn.utils import clip_grad_value_
 from multi_backward import MultiBackward
+from prefetch_loader import PrefetchLoader
 from loss import Loss
 import time
 script_dir = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1])
@@ -38,44 +39,59 @@ class Train():
         self.model = RoseTTAFoldModule_e2e(**MODEL_PARAM).to(self.device)
         self.loss = Loss(self.device)
 
-    def train_with_mask(self, data_path):
-        train_data = data_reader.DataRead(data_path)
-        # dataloader = torch.utils.data.DataLoader(train_data, batch_size=2, shuffle=True, collate_fn=data_reader.collate_batch_data)
-        dataloader = torch.utils.data.DataLoader(train_data, batch_size=1, shuffle=True)
+    def train_with_mask(self, data_path, max_tokens=None, num_workers=0, prefetch=2, crop=None, accum_tokens=None):
+        # max_tokens: msa tokens (B x N x L) of a micro-batch, see TokenBucketSampler
+        # accum_tokens: L^2 x N tokens accumulated per optimizer step, None for a step per micro-batch
+        train_data = data_reader.DataRead(data_path, crop=crop)
+        use_cuda = self.device.type == "cuda"
+        # collate pins in the main process only, workers leave pinning to the DataLoader
+        # the lddt_loss neighbor lists are built with the batch, in the loader
+        collate_fn = partial(data_reader.collate_batch_data, pin_memory=use_cuda and num_workers == 0,
+                             lddt_cutoff=self.loss.lddt_cutoff)
+        loader_args = {"collate_fn": collate_fn, "num_workers": num_workers, "pin_memory": use_cuda and num_workers > 0}
+        if max_tokens:
+            # batches of similar L x N, padded up to at most max_tokens msa tokens
+            sampler = data_reader.TokenBucketSampler(train_data.sizes(), max_tokens=max_tokens)
+            print("%d batches an epoch, padding overhead %.1f%%" % (len(sampler), 100 * sampler.padding_overhead()))
+            dataloader = torch.utils.data.DataLoader(train_data, batch_sampler=sampler, **loader_args)
+        else:
+            sampler = None
+            dataloader = torch.utils.data.DataLoader(train_data, batch_size=1, shuffle=True, **loader_args)
+        # batches arrive on self.device, copied in the background
+        dataloader = PrefetchLoader(dataloader, self.device, depth=prefetch)
         optimizer = optim.Adam(self.model.parameters(), lr=0.001)
         scheduler = lr_scheduler.MultiStepLR(optimizer, [500, 800], 0.1)
         epoch_max = 2000
+        multi_back = MultiBackward(optimizer, accum_tokens or 0, self.model.parameters(), clip_value=1, model=self.model)
         
         for epoch in range(epoch_max):
+            if sampler is not None:
+                sampler.set_epoch(epoch)
             avg_loss, data_cnt = 0, 0
-            multi_back = MultiBackward(optimizer, 1)
+            dataloader.reset_stats()
             weight = (epoch + 1) / epoch_max * 0.2 + 0.05
             for batch_idx, data in enumerate(dataloader):
-                optimizer.zero_grad()
-                feat, label, masks = data
-                feat = [i.to(self.device) for i in feat]
-                label = [i.to(self.device) for i in label]
-                dis_mask = masks.to(self.device)
+                feat, label, dis_mask, lengths, pad_mask, neighbors = data
                 msa, xyz_t, t1d, t0d = feat
                 xyz_label, dis_label, omega_label, theta_label, phi_label  = label
                 xyz, model_lddt, prob_s = self.get_model_result(msa, xyz_t, t1d, t0d)
-                dis_prob, omega_prob, theta_prob, phi_prob = prob_s
                 batch_size = xyz_label.shape[0]
 
-                dis_loss = self.loss.cross_loss_mask(dis_prob.float(), dis_label, dis_mask)
-                oemga_loss = self.loss.cross_loss_mask(omega_prob.float(), omega_label, dis_mask)
-                theta_loss = self.loss.cross_loss_mask(theta_prob.float(), theta_label, dis_mask)
-                phi_loss = self.loss.cross_loss_mask(phi_prob.float(), phi_label, dis_mask)
+                # every loss is a mean over the real residues of each sample
+                dis_loss, oemga_loss, theta_loss, phi_loss = self.loss.cross_loss_heads(\
+                    prob_s, [dis_label, omega_label, theta_label, phi_label], dis_mask, pad_mask)
 
                 xyz = xyz.view(batch_size, -1, 3)
-                xyz_loss = self.loss.coords_loss_rotate(xyz.float(), xyz_label.float())
-                dis_loss_whole = self.loss.dis_mse_whole_atom(xyz.float(), xyz_label.float())
+                xyz_loss = self.loss.coords_loss_rotate(xyz.float(), xyz_label.float(), pad_mask)
+                dis_loss_whole = self.loss.dis_mse_whole_atom(xyz.float(), xyz_label.float(), pad_mask)
 
-                xyz_ca = xyz.view(batch_size, -1, 3, 3)[:,:,1]
-                xyz_label_ca = xyz_label.view(batch_size, -1, 3, 3)[:,:,1]
-                lddt_result = lddt_torch.lddt(xyz_ca.float(), xyz_label_ca.float())
+                # printed only, keep it out of the graph
+                with torch.no_grad():
+                    xyz_ca = xyz.view(batch_size, -1, 3, 3)[:,:,1]
+                    xyz_label_ca = xyz_label.view(batch_size, -1, 3, 3)[:,:,1]
+                    lddt_result = lddt_torch.lddt(xyz_ca.float(), xyz_label_ca.float(), chunk=self.loss.chunk)
 
-                lddt_loss = self.loss.lddt_loss(xyz.float(), xyz_label.float(), model_lddt)
+                lddt_loss = self.loss.lddt_loss(xyz.float(), xyz_label.float(), model_lddt, neighbors, pad_mask)
                 loss = [\
                     dis_loss, \
                     oemga_loss, \
@@ -88,17 +104,18 @@ class Train():
                     ]
                 print("all loss ", ["%.2f" % i.data for i in loss], "weight", weight)
                 sum_loss = sum(loss)
-                sum_loss.backward()
-                clip_grad_value_(self.model.parameters(), 1)
-                optimizer.step()
+                # backward now, optimizer step (and clipping) once accum_tokens are in
+                multi_back.add_loss(sum_loss, n_samples=batch_size, tokens=MultiBackward.batch_tokens(msa))
                 avg_loss += sum_loss.cpu().detach().numpy()
                 data_cnt += 1
-            clip_grad_value_(self.model.parameters(), 1)
+            multi_back.flush()
             
             scheduler.step()
             avg_loss = avg_loss / data_cnt
             print("time is ", get_time(), end = " ")
             print(f"=====train epoch {epoch} avg_loss {avg_loss} lddt {lddt_result} model lddt {torch.mean(model_lddt)}")
+            stats = dataloader.stats()
+            print("data wait %.1fs compute %.1fs (%.1f%% waiting)" % (stats["wait"], stats["compute"], 100 * stats["wait_frac"]))
 
     def for_single(self, msa, t1d, t2d):
         B, N, L = msa.shape
@@ -109,10 +126,8 @@ class Train():
         t1d = t1d[:,:10].to(self.device)
         t2d = t2d[:,:10].to(self.device)
 
+        # logits stay (B, C, L, L), Loss.cross_loss_heads reads them in place
         logit_s, _, xyz, lddt = self.model(msa, seq, idx_pdb, t1d=t1d, t2d=t2d)
-        logit_s = list(logit_s)
-        for i, v in enumerate(logit_s):
-            logit_s[i] = v.permute(0,2,3,1)
         return xyz, lddt, logit_s # 目前只知道距离的计算方法，还不知道角度的计算方法
     def get_model_result(self, msa, xyz_t, t1d, t0d, window=150, shift=75):
         B, N, L = msa.shape
@@ -127,5 +142,5 @@ class Train():
 
 if __name__ == "__main__":
     train = Train(use_cpu=True)
-    train.train_with_mask("./generate_feat/train_data.pickle")
+    train.train_with_mask("./generate_feat/train_store")
 
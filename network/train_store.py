@@ -0,0 +1,293 @@
+'''
+Sharded, memory-mapped store of pre-computed training samples.
+
+A store is a directory with an index.json (shard files, and the shard and row
+of every sample) and N shard files in mmap_store format. Every field of a
+sample is kept as one flat typed array per shard:
+  <field>        all samples of the shard, flattened and concatenated
+  <field>_start  (n+1,) offset of every sample into <field>
+  <field>_shape  (n, ndim) shape of every sample
+so that a sample is read back as views of the mapped shard. TrainStore opens
+shards on first use in every process, which keeps DataLoader workers from
+copying the dataset.
+'''
+import json
+import os
+import time
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+import mmap_store
+from kinematics import xyz_to_bins
+
+INDEX = "index.json"
+
+# field -> storage dtype
+FEAT_FIELDS = {
+    "msa": np.uint8,
+    "xyz_t": np.float32,
+    "t1d": np.float32,
+    "t0d": np.float32,
+    "xyz": np.float32,
+}
+# labels are stored either binned, or as the N,Ca,C,Cb coordinates they are
+# computed from in __getitem__ (for the cropped residues only)
+LABEL_FIELDS = {
+    "bins": {
+        "dis": np.uint8,
+        "omega": np.uint8,
+        "theta": np.uint8,
+        "phi": np.uint8,
+        "mask": bool,
+    },
+    "ncaccb": {
+        "ncaccb": np.float32,
+    },
+}
+
+# L x L fields, stored in tile x tile blocks so that a crop reads only the
+# tiles it overlaps (64 x 64 uint8/bool is one 4 KB page)
+PAIR_FIELDS = ["dis", "omega", "theta", "phi", "mask"]
+TILE = 64
+
+def store_fields(labels="bins"):
+    fields = dict(FEAT_FIELDS)
+    fields.update(LABEL_FIELDS[labels])
+    return fields
+
+def shard_filename(i):
+    return "shard%05d.rfs" % i
+
+def to_tiles(a, tile):
+    '''
+    (L0, L1) array -> (n0, n1, tile, tile) contiguous tiles, zero padded
+    '''
+    n0, n1 = -(-a.shape[0] // tile), -(-a.shape[1] // tile)
+    out = np.zeros((n0 * tile, n1 * tile), dtype=a.dtype)
+    out[:a.shape[0], :a.shape[1]] = a
+    return np.ascontiguousarray(out.reshape(n0, tile, n1, tile).transpose(0, 2, 1, 3))
+
+def read_tiles(tiles, shape, tile, sel=None):
+    '''
+    a[sel][:, sel] of the square array stored by to_tiles, touching only the
+    tiles that hold sel x sel
+    '''
+    n = -(-shape[0] // tile)
+    tiles = tiles.reshape(n, n, tile, tile)
+    sel = np.arange(shape[0]) if sel is None else np.asarray(sel)
+    t = np.unique(sel // tile)
+    block = tiles[t[:,None], t[None,:]].transpose(0, 2, 1, 3).reshape(len(t) * tile, len(t) * tile)
+    pos = np.searchsorted(t, sel // tile) * tile + sel % tile
+    return block[np.ix_(pos, pos)]
+
+class TrainStoreWriter:
+    '''
+    Append samples (dicts of store_fields(labels) arrays) and cut a new shard
+    every shard_bytes, or once the oldest pending sample has waited
+    flush_secs, so that a killed writer loses at most that much work.
+
+    With append=True an existing store is extended; adding a name that is
+    already in the store replaces it. The index is rewritten after every
+    shard, so an interrupted writer leaves a readable store behind.
+    '''
+    def __init__(self, dirname, shard_bytes=1<<30, append=False, labels="bins", tile=TILE, flush_secs=None):
+        self.dirname = dirname
+        self.shard_bytes = shard_bytes
+        self.flush_secs = flush_secs
+        self.tile = tile
+        self.labels = labels
+        self.fields = store_fields(labels)
+        os.makedirs(dirname, exist_ok=True)
+        self.shards = []
+        self.samples = {}
+        if append and is_train_store(dirname):
+            index = read_index(dirname)
+            if index.get("labels", "bins") != labels:
+                raise ValueError("%s stores %s labels, not %s" % (dirname, index.get("labels", "bins"), labels))
+            self.shards = index["shards"]
+            self.samples = {s["name"]: s for s in index["samples"]}
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+
+    def add(self, name, sample, meta=None):
+        '''
+        True if the sample (and all pending ones) went to disk
+        '''
+        sample = {k: np.asarray(sample[k], dtype=dtype) for k, dtype in self.fields.items()}
+        if not self.pending:
+            self.pending_since = time.time()
+        self.pending.append((name, sample, meta))
+        self.pending_bytes += sum([v.nbytes for v in sample.values()])
+        if self.pending_bytes >= self.shard_bytes or \
+                (self.flush_secs is not None and time.time() - self.pending_since >= self.flush_secs):
+            self.flush()
+            return True
+        return False
+
+    def remove(self, name):
+        self.samples.pop(name, None)
+        self.pending = [p for p in self.pending if p[0] != name]
+
+    def __contains__(self, name):
+        return name in self.samples
+
+    def meta(self, name):
+        return self.samples[name].get("meta")
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        arrays = {}
+        for k in self.fields:
+            vals = [s[k] for _, s, _ in self.pending]
+            arrays[k + "_shape"] = np.array([v.shape for v in vals], dtype=np.int64).reshape(len(vals), -1)
+            if k in PAIR_FIELDS and self.tile:
+                vals = [to_tiles(v, self.tile) for v in vals]
+            arrays[k] = np.concatenate([v.reshape(-1) for v in vals])
+            arrays[k + "_start"] = np.cumsum([0] + [v.size for v in vals]).astype(np.int64)
+        fn = shard_filename(len(self.shards))
+        path = os.path.join(self.dirname, fn)
+        mmap_store.write_arrays(path + ".tmp", arrays, {"tile": self.tile})
+        os.replace(path + ".tmp", path)
+        for row, (name, _, meta) in enumerate(self.pending):
+            self.samples[name] = {"name": name, "shard": len(self.shards), "row": row, "meta": meta}
+        self.shards.append(fn)
+        self.pending = []
+        self.pending_bytes = 0
+        self.write_index()
+
+    def write_index(self):
+        index = {"labels": self.labels, "fields": {k: np.dtype(v).str for k, v in self.fields.items()},
+                 "shards": self.shards, "samples": list(self.samples.values())}
+        path = os.path.join(self.dirname, INDEX)
+        with open(path + ".tmp", "w") as fh:
+            json.dump(index, fh)
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        self.flush()
+        self.write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_index(dirname):
+    with open(os.path.join(dirname, INDEX)) as fh:
+        return json.load(fh)
+
+def is_train_store(path):
+    return os.path.isfile(os.path.join(path, INDEX))
+
+class TrainStore(Dataset):
+    '''
+    Samples of a store as (feat, label, masks) tensors. With crop, samples
+    longer than crop residues are cut to a random continuous window of crop
+    residues, chosen before the sample is read, so that only the window of
+    every field (and the tiles of L x L fields it covers) is loaded.
+    '''
+    def __init__(self, dirname, crop=None):
+        super().__init__()
+        self.dirname = dirname
+        self.crop = crop
+        index = read_index(dirname)
+        self.labels = index.get("labels", "bins")
+        self.fields = store_fields(self.labels)
+        self.shard_files = index["shards"]
+        self.names = [s["name"] for s in index["samples"]]
+        self.sample_shard = np.array([s["shard"] for s in index["samples"]], dtype=np.int64)
+        self.sample_row = np.array([s["row"] for s in index["samples"]], dtype=np.int64)
+        self._shards = {}
+
+    def __getstate__(self):
+        # mappings are not shared with (or pickled into) worker processes
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def __len__(self):
+        return len(self.names)
+
+    def shard(self, i):
+        if i not in self._shards:
+            self._shards[i] = mmap_store.map_arrays(os.path.join(self.dirname, self.shard_files[i]))
+        return self._shards[i]
+
+    def sizes(self):
+        '''
+        (n, 2) msa shape of every sample, without reading the samples
+        '''
+        out = np.zeros((len(self), 2), dtype=np.int64)
+        for i in range(len(self.shard_files)):
+            sel = np.where(self.sample_shard == i)[0]
+            if len(sel):
+                out[sel] = self.shard(i)[0]["msa_shape"][self.sample_row[sel]]
+        if self.crop is not None:
+            out[:,1] = np.minimum(out[:,1], self.crop)
+        return out
+
+    def locate(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("sample %d out of range" % index)
+        return self.shard(int(self.sample_shard[index])), int(self.sample_row[index])
+
+    def length(self, index):
+        (arrays, meta), j = self.locate(index)
+        return int(arrays["msa_shape"][j, 1])
+
+    def crop_sel(self, L):
+        '''
+        residues to load of a sample of length L, None for all of them
+        '''
+        if self.crop is None or L <= self.crop:
+            return None
+        start = int(torch.randint(L - self.crop + 1, (1,)))
+        return np.arange(start, start + self.crop)
+
+    def sample(self, index, sel=None):
+        '''
+        numpy arrays of all fields of sample `index`, restricted to residues sel
+        (read-only views of the whole sample if sel is None)
+        '''
+        (arrays, meta), j = self.locate(index)
+        tile = meta.get("tile")
+        out = {}
+        for k in self.fields:
+            b, e = arrays[k + "_start"][j], arrays[k + "_start"][j+1]
+            shape = arrays[k + "_shape"][j]
+            if k in PAIR_FIELDS:
+                if tile:
+                    out[k] = read_tiles(arrays[k][b:e], shape, tile, sel)
+                else:
+                    v = arrays[k][b:e].reshape(shape)
+                    out[k] = v if sel is None else v[np.ix_(sel, sel)]
+                continue
+            v = arrays[k][b:e].reshape(shape)
+            if sel is not None:
+                if k in ["msa", "xyz_t", "t1d"]:
+                    v = v[:, sel]
+                elif k == "xyz":
+                    v = v.reshape(shape[0] // 3, 3, 3)[sel].reshape(-1, 3)
+                elif k == "ncaccb":
+                    v = v[sel]
+            out[k] = v
+        return out
+
+    def __getitem__(self, index):
+        s = self.sample(index, self.crop_sel(self.length(index)))
+        feat = (torch.from_numpy(s["msa"].astype(np.int64)),
+                torch.tensor(s["xyz_t"]), torch.tensor(s["t1d"]), torch.tensor(s["t0d"]))
+        xyz = torch.tensor(s["xyz"])
+        if self.labels == "ncaccb":
+            ncaccb = torch.tensor(s["ncaccb"].reshape(-1, 4, 3))
+            dis, omega, theta, phi, masks = [v[0] for v in xyz_to_bins(ncaccb[None])]
+        else:
+            # bins stay uint8 and the mask bool up to the loss
+            dis, omega, theta, phi = [torch.from_numpy(s[k].astype(np.uint8)) for k in ["dis", "omega", "theta", "phi"]]
+            masks = torch.from_numpy(s["mask"].astype(bool))
+        return feat, (xyz, dis, omega, theta, phi), masks